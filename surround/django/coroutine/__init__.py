@@ -1,5 +1,43 @@
 from django.conf import settings
 from django.utils.module_loading import import_string
+from surround.django import execution
+from surround.django import instrumentation
+from surround.django.policies import with_policies
 
-execute_all = import_string(settings.SURROUND_COROUTINE_IMPLEMENTATION_MODULE + '.execute_all')
+_execute_all = import_string(settings.SURROUND_COROUTINE_IMPLEMENTATION_MODULE + '.execute_all')
+
+try:
+    _execute_iter = import_string(settings.SURROUND_COROUTINE_IMPLEMENTATION_MODULE + '.execute_iter')
+except ImportError:
+    # implementations not streaming their results yield them all once the batch is finished
+    def _execute_iter(func, multi, *args, **kwargs):
+        return _execute_all(func, multi, *args, **kwargs).items()
+
+
+# calls with equal parameters are executed once, their results shared by all names, see execution.deduplicate;
+# the collapsed calls are counted in the metrics of the function
+def _deduplicate(func, multi):
+    unique, copies = execution.deduplicate(multi)
+    if copies:
+        name = '%s.%s' % (func.__module__, getattr(func, '__name__', func.__class__.__name__))
+        instrumentation.registry.get(name).collapsed += sum(len(names) for names in copies.values())
+    return unique, copies
+
+
+# policies wrap every call, see execution.execute
+def execute_all(func, multi, *args, **kwargs):
+    func = with_policies(func, kwargs.pop('policies', None))
+    unique, copies = _deduplicate(func, multi)
+    if not copies:
+        return _execute_all(func, multi, *args, **kwargs)
+    return execution.MultiResult(execution.fan_out(_execute_all(func, unique, *args, **kwargs).results, copies))
+
+
+def execute_iter(func, multi, *args, **kwargs):
+    func = with_policies(func, kwargs.pop('policies', None))
+    unique, copies = _deduplicate(func, multi)
+    for name, result in _execute_iter(func, unique, *args, **kwargs):
+        yield name, result
+        for copy in copies.get(name, ()):
+            yield copy, result
 
@@ -0,0 +1,70 @@
+import asyncio
+import functools
+import time
+from django.conf import settings
+from surround.django import execution
+from surround.django import context_cache
+
+from surround.django.logging import setupModuleLogger
+setupModuleLogger(globals())
+
+# asyncio counterparts of execution.execute and execute_all, python 3 only;
+# unlike the other implementations it cannot be used as SURROUND_COROUTINE_IMPLEMENTATION_MODULE,
+# since its functions have to be awaited
+
+
+async def execute(func, parameters):
+    try:
+        if asyncio.iscoroutinefunction(func):
+            value = await func(*parameters.args, **parameters.kwargs)
+        else:
+            # blocking functions run in the default executor, with the context cache of the caller
+            call = functools.partial(context_cache.wrap_with_current(func), *parameters.args, **parameters.kwargs)
+            value = await asyncio.get_event_loop().run_in_executor(None, call)
+        return execution.Result(value, None)
+    except Exception as e:
+        if settings.SURROUND_EXECUTION_DEBUG:
+            raise
+        return execution.Result(None, e)
+
+
+async def _execute_with_timeout(func, parameters, timeout):
+    if timeout is None:
+        return await execute(func, parameters)
+    try:
+        return await asyncio.wait_for(execute(func, parameters), timeout)
+    except asyncio.TimeoutError:
+        return execution.timed_out()
+
+
+# yields (name, result) pairs in the order the calls finish; calls running longer than timeout seconds or
+# not finished by the deadline (an epoch timestamp) are cancelled and result in execution.TimeoutError,
+# blocking functions keep running in the executor
+async def execute_iter(func, multi, max_parallel=None, timeout=None, deadline=None):
+    semaphore = asyncio.Semaphore(max_parallel) if max_parallel is not None else None
+
+    async def call(name):
+        if semaphore is None:
+            return name, await _execute_with_timeout(func, multi[name], timeout)
+        async with semaphore:
+            return name, await _execute_with_timeout(func, multi[name], timeout)
+
+    pending = list(multi.keys())
+    tasks = [asyncio.ensure_future(call(name)) for name in pending]
+    try:
+        for finished in asyncio.as_completed(tasks, timeout=max(deadline - time.time(), 0) if deadline is not None else None):
+            try:
+                name, result = await finished
+            except asyncio.TimeoutError:
+                break
+            pending.remove(name)
+            yield name, result
+        for name in pending:
+            yield name, execution.timed_out()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def execute_all(func, multi, max_parallel=None, timeout=None, deadline=None):
+    return execution.MultiResult(dict([item async for item in execute_iter(func, multi, max_parallel, timeout, deadline)]))
@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+import os
+import threading
+import time
+# on python 2 provided by the futures package
+from concurrent.futures import wait, FIRST_COMPLETED
+
+# shared by the executor based implementations of execute_all
+
+
+# holds the executor made by create, created lazily and once per process, since neither threads nor the pipes
+# to worker processes survive forking of the workers
+class LazyExecutor(object):
+
+    def __init__(self, create):
+        self.create = create
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._pid == os.getpid():
+            return self._executor
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = self.create()
+                self._pid = os.getpid()
+            return self._executor
+
+    # only the given executor is dropped, it may have been replaced already
+    def drop(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+                self._pid = None
+        executor.shutdown(wait=False)
+
+
+# submits the jobs, at most limit of them at a time, and yields (job, future) pairs as they finish; submit(job)
+# returns the future of the job and a list holding the time it started, None until then. Once the deadline
+# passes the futures not done are cancelled and the batch is finished; jobs running longer than timeout_of(job)
+# are given up on alone. Timed out jobs are yielded with None in place of the future. Cancelling running jobs
+# is not possible with executors, they finish in the background unnoticed; until then they still count against
+# limit, so that the jobs submitted next do not wait for the worker they hold.
+def iter_jobs(submit, jobs, limit, timeout_of=None, deadline=None):
+    queued = list(reversed(jobs))
+    running = {}
+    abandoned = set()
+    while queued or running:
+        while queued and len(running) + len(abandoned) < limit:
+            job = queued.pop()
+            future, started = submit(job)
+            running[future] = (job, started)
+
+        now = time.time()
+        wait_time = deadline - now if deadline is not None else None
+        if timeout_of is not None:
+            for job, started in running.values():
+                # jobs not started yet are checked again a timeout later
+                remaining = timeout_of(job) - (now - started[0] if started[0] is not None else 0)
+                wait_time = remaining if wait_time is None else min(wait_time, remaining)
+
+        done, _ = wait(set(running) | abandoned, timeout=max(wait_time, 0) if wait_time is not None else None,
+                       return_when=FIRST_COMPLETED)
+        for future in done:
+            if future in abandoned:
+                abandoned.remove(future)
+            else:
+                yield running.pop(future)[0], future
+
+        now = time.time()
+        if deadline is not None and now >= deadline:
+            for future, (job, started) in list(running.items()):
+                future.cancel()
+                yield job, None
+            for job in reversed(queued):
+                yield job, None
+            return
+        if timeout_of is not None:
+            for future, (job, started) in list(running.items()):
+                if started[0] is not None and now - started[0] >= timeout_of(job):
+                    if not future.cancel():
+                        abandoned.add(future)
+                    del running[future]
+                    yield job, None
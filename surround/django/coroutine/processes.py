@@ -0,0 +1,220 @@
+from __future__ import absolute_import
+import importlib
+import marshal
+import multiprocessing
+import pickle
+import time
+# on python 2 provided by the futures package
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:
+    class BrokenProcessPool(RuntimeError):
+        pass
+from django.conf import settings
+from surround.django import execution
+from surround.django.policies import PolicyFunction, with_policies
+from surround.django.coroutine import simple
+from surround.django.coroutine.pool import iter_jobs, LazyExecutor
+
+from surround.django.logging import setupModuleLogger
+setupModuleLogger(globals())
+
+# runs the calls on a pool of worker processes shared by all batches of the process, suited for CPU bound
+# functions; calls are sent in chunks, each chunk computed sequentially in one worker, so at most max_parallel
+# chunks of a single batch, and never more than there are workers, are in flight at the same time
+#
+# the function has to be importable by its name from its module, with cache proxies in place of the functions
+# they decorate being unwrapped, and policies pickled along; other functions, and ones with policies failing
+# to pickle, are executed in the calling process. The context cache of the caller is not available in the workers.
+#
+# chunks not finished by the deadline (an epoch timestamp), or within timeout seconds per call since their
+# submission, result in execution.TimeoutError for all their calls; chunks not started yet are cancelled,
+# running ones are left to finish in the workers
+#
+# calls whose arguments fail to pickle, and the calls of chunks failing in the pool, like the ones lost with
+# a crashed worker, result in the exception raised; a broken pool is replaced for the following submissions
+
+MAX_WORKERS = getattr(settings, 'SURROUND_COROUTINE_PROCESSES', None) or multiprocessing.cpu_count()
+# by default about four chunks per worker, to even out uneven calls
+CHUNK_SIZE = getattr(settings, 'SURROUND_COROUTINE_PROCESS_CHUNK_SIZE', None)
+
+_executor = LazyExecutor(lambda: ProcessPoolExecutor(max_workers=MAX_WORKERS))
+_in_worker = False
+
+try:
+    _SIMPLE_TYPES = (type(None), bool, int, long, float, str, unicode, bytes)
+except NameError:
+    _SIMPLE_TYPES = (type(None), bool, int, float, str, bytes)
+
+_MARSHAL = 0
+_PICKLE = 1
+
+
+# a broken pool is replaced, a batch may find it already replaced by another one
+def _submit(*args):
+    executor = _executor.get()
+    try:
+        return executor, executor.submit(*args)
+    except BrokenProcessPool:
+        _executor.drop(executor)
+        executor = _executor.get()
+        return executor, executor.submit(*args)
+
+
+# values marshal round trips exactly, without the classes pickle has to look up
+def _is_simple(value):
+    if type(value) in (tuple, list):
+        return all(_is_simple(item) for item in value)
+    if type(value) is dict:
+        return all(_is_simple(k) and _is_simple(v) for k, v in value.items())
+    return type(value) in _SIMPLE_TYPES
+
+
+def _dumps(values):
+    if _is_simple(values):
+        return _MARSHAL, marshal.dumps(values)
+    return _PICKLE, pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+
+
+def _loads(encoded):
+    encoding, data = encoded
+    return marshal.loads(data) if encoding == _MARSHAL else pickle.loads(data)
+
+
+def _reference(func):
+    if isinstance(func, PolicyFunction):
+        return _reference(func.func) + (func.policies,)
+    return func.__module__, getattr(func, '__qualname__', func.__name__)
+
+
+def _resolve(reference):
+    module, name = reference[:2]
+    obj = importlib.import_module(module)
+    for part in name.split('.'):
+        obj = getattr(obj, part)
+    obj = getattr(obj, 'func', obj)
+    if len(reference) > 2:
+        return with_policies(obj, reference[2])
+    return obj
+
+
+# policies are pickled along with the reference, in the feeder thread of the pool where a failure would be
+# reported for the whole chunk
+def _importable(func):
+    if isinstance(func, PolicyFunction):
+        try:
+            pickle.dumps(func.policies, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return False
+        func = func.func
+    try:
+        return _resolve(_reference(func)) is func
+    except (ImportError, AttributeError):
+        return False
+
+
+# results failing to pickle, like exceptions holding sockets, are replaced with an ExecutionException
+def _dumps_results(results):
+    if all(result.exception is None for result in results):
+        values = [result.value for result in results]
+        if _is_simple(values):
+            return _MARSHAL, marshal.dumps(values)
+    pickled = []
+    for result in results:
+        try:
+            pickled.append(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            exception = result.exception if result.exception is not None else e
+            failure = execution.ExecutionException('%s: %s' % (type(exception).__name__, exception))
+            pickled.append(pickle.dumps(execution.Result(None, failure), pickle.HIGHEST_PROTOCOL))
+    return _PICKLE, pickled
+
+
+# calls failing to pickle are left out of the chunk, with their failure stored in failed
+def _dumps_chunk(multi, chunk, failed):
+    calls = [(multi[name].args, multi[name].kwargs) for name in chunk]
+    try:
+        return chunk, _dumps(calls)
+    except Exception:
+        pass
+    kept = []
+    for name, call in zip(chunk, calls):
+        try:
+            _dumps([call])
+            kept.append((name, call))
+        except Exception as e:
+            failed[name] = execution.Result(None, e)
+    if not kept:
+        return (), None
+    return tuple(name for name, call in kept), _dumps([call for name, call in kept])
+
+
+def _loads_results(encoded):
+    encoding, data = encoded
+    if encoding == _MARSHAL:
+        return [execution.Result(value, None) for value in marshal.loads(data)]
+    return [pickle.loads(result) for result in data]
+
+
+def _execute_chunk(reference, encoded_calls):
+    global _in_worker
+    _in_worker = True
+    func = _resolve(reference)
+    results = [execution.execute(func, execution.Parameters(tuple(args), kwargs)) for args, kwargs in _loads(encoded_calls)]
+    return _dumps_results(results)
+
+
+def _chunk_size(count):
+    if CHUNK_SIZE:
+        return CHUNK_SIZE
+    return max(1, -(-count // (4 * MAX_WORKERS)))
+
+
+# yields (name, result) pairs as the chunks finish
+def execute_iter(func, multi, max_parallel=None, timeout=None, deadline=None):
+    # batches started by the calls themselves run in their worker, instead of starting pools of their own
+    if (len(multi) <= 1 and timeout is None and deadline is None) or _in_worker or not _importable(func):
+        for item in simple.execute_iter(func, multi, deadline=deadline):
+            yield item
+        return
+
+    reference = _reference(func)
+    names = list(multi.keys())
+    size = _chunk_size(len(names))
+    failed = {}
+    jobs = [_dumps_chunk(multi, tuple(names[offset:offset + size]), failed) for offset in range(0, len(names), size)]
+    jobs = [job for job in jobs if job[0]]
+    for item in failed.items():
+        yield item
+    if not jobs:
+        return
+
+    executors = {}
+
+    # the start of a chunk in a worker is not known, so it is counted from its submission; with no more chunks
+    # in flight than workers, timed out ones included until they finish, they do not queue behind each other,
+    # only behind other batches sharing the pool
+    def submit(job):
+        executor, future = _submit(_execute_chunk, reference, job[1])
+        executors[future] = executor
+        return future, [time.time()]
+
+    for (chunk, _), future in iter_jobs(submit, jobs, min(max_parallel or len(jobs), MAX_WORKERS),
+                                        (lambda job: timeout * len(job[0])) if timeout is not None else None, deadline):
+        if future is None:
+            for name in chunk:
+                yield name, execution.timed_out()
+            continue
+        try:
+            results = _loads_results(future.result())
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                _executor.drop(executors[future])
+            results = [execution.Result(None, e)] * len(chunk)
+        for item in zip(chunk, results):
+            yield item
+
+
+def execute_all(func, multi, max_parallel=None, timeout=None, deadline=None):
+    return execution.MultiResult(dict(execute_iter(func, multi, max_parallel, timeout, deadline)))
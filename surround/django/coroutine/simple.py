@@ -1,3 +1,4 @@
+import time
 from surround.django import execution
 
 from surround.django.logging import setupModuleLogger
@@ -5,6 +6,16 @@ setupModuleLogger(globals())
 
 
 
-def execute_all(func, multi, max_parallel=None):
-    return execution.MultiResult({name: execution.execute(func, parameters) for name, parameters in multi.items()})
+# calls run one after another and cannot be interrupted, so timeout is not enforced; calls not started
+# by the deadline (an epoch timestamp) result in execution.TimeoutError
+def execute_iter(func, multi, max_parallel=None, timeout=None, deadline=None):
+    for name, parameters in multi.items():
+        if deadline is not None and time.time() >= deadline:
+            yield name, execution.timed_out()
+        else:
+            yield name, execution.execute(func, parameters)
+
+
+def execute_all(func, multi, max_parallel=None, timeout=None, deadline=None):
+    return execution.MultiResult(dict(execute_iter(func, multi, max_parallel, timeout, deadline)))
 
@@ -0,0 +1,54 @@
+from __future__ import absolute_import
+import threading
+import time
+# on python 2 provided by the futures package
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from surround.django import execution
+from surround.django import context_cache
+from surround.django.coroutine import simple
+from surround.django.coroutine.pool import iter_jobs, LazyExecutor
+
+from surround.django.logging import setupModuleLogger
+setupModuleLogger(globals())
+
+# runs the calls on a thread pool shared by all batches of the process, suited for functions waiting on
+# network backends; at most max_parallel calls of a single batch run at the same time
+#
+# calls running longer than timeout seconds or not finished by the deadline (an epoch timestamp) result in
+# execution.TimeoutError; calls not started yet are cancelled, running ones are left to finish in the background
+
+MAX_WORKERS = getattr(settings, 'SURROUND_COROUTINE_THREADS', 16)
+
+_executor = LazyExecutor(lambda: ThreadPoolExecutor(max_workers=MAX_WORKERS))
+_worker = threading.local()
+
+
+def _execute_in_worker(func, parameters, started):
+    _worker.active = True
+    started[0] = time.time()
+    return execution.execute(func, parameters)
+
+
+# yields (name, result) pairs in the order the calls finish
+def execute_iter(func, multi, max_parallel=None, timeout=None, deadline=None):
+    # batches started by the calls themselves run in their worker, waiting for the pool from inside of it could exhaust it
+    if (len(multi) <= 1 and timeout is None and deadline is None) or getattr(_worker, 'active', False):
+        for item in simple.execute_iter(func, multi, deadline=deadline):
+            yield item
+        return
+
+    executor = _executor.get()
+    call = context_cache.wrap_with_current(_execute_in_worker)
+
+    def submit(name):
+        started = [None]
+        return executor.submit(call, func, multi[name], started), started
+
+    for name, future in iter_jobs(submit, list(multi.keys()), max_parallel or len(multi),
+                                  (lambda name: timeout) if timeout is not None else None, deadline):
+        yield name, future.result() if future is not None else execution.timed_out()
+
+
+def execute_all(func, multi, max_parallel=None, timeout=None, deadline=None):
+    return execution.MultiResult(dict(execute_iter(func, multi, max_parallel, timeout, deadline)))
@@ -1,6 +1,13 @@
 from __future__ import absolute_import
 from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
+import threading
 from django.conf import settings
+from django.db import connections
+from surround.django import context_cache
+from surround.django.policies import with_policies
+from surround.django.sharding import map_concurrently
 
 from surround.django.logging import setupModuleLogger
 
@@ -40,10 +47,29 @@ class Result(namedtuple('Result', ['value', 'exception'])):
 
 
 
+def _canonical(value):
+    if isinstance(value, (list, tuple)):
+        return value.__class__, tuple(_canonical(item) for item in value)
+    if isinstance(value, dict):
+        return value.__class__, frozenset((_canonical(k), _canonical(v)) for k, v in value.items())
+    if isinstance(value, (set, frozenset)):
+        return value.__class__, frozenset(_canonical(item) for item in value)
+    return value.__class__, value
+
+
 class Parameters(namedtuple('Parameters', ['args', 'kwargs'])):
 
     __slots__ = ()
 
+    # hashable form, equal for equal arguments of the same types, or None if some argument is not hashable
+    def canonical(self):
+        try:
+            canonical = (_canonical(self.args), _canonical(self.kwargs))
+            hash(canonical)
+            return canonical
+        except TypeError:
+            return None
+
     def __str__(self):
         return ', '.join(list(map(str, self.args)) + ['%s=%r' % (k, v) for k, v in self.kwargs.items()])
 
@@ -52,7 +78,10 @@ def parameters(*args, **kwargs):
     return Parameters(args, kwargs)
 
 
-def execute(func, parameters):
+# policies, like policies.RetryPolicy and HedgePolicy, wrap the call, the first of them being the outermost
+def execute(func, parameters, policies=None):
+    if policies:
+        func = with_policies(func, policies)
     try:
         return Result(func(*parameters.args, **parameters.kwargs), None)
     except Exception as e:
@@ -64,6 +93,17 @@ def execute(func, parameters):
 class ExecutionException(Exception):
     pass
 
+try:
+    TimeoutError = TimeoutError
+except NameError:
+    # python 2
+    class TimeoutError(Exception):
+        pass
+
+
+def timed_out():
+    return Result(None, TimeoutError('execution did not finish in time'))
+
 class MultiParameters(dict):
 
 
@@ -74,36 +114,152 @@ class MultiParameters(dict):
         self[name] = parameters
 
 
+# returns the parameters without duplicates, along with the names dropped for each name kept
+def deduplicate(multi):
+    unique = MultiParameters()
+    copies = {}
+    kept = {}
+    for name, parameters in multi.items():
+        canonical = parameters.canonical()
+        if canonical is not None and canonical in kept:
+            copies.setdefault(kept[canonical], []).append(name)
+            continue
+        if canonical is not None:
+            kept[canonical] = name
+        unique.add(name, parameters)
+    return unique, copies
+
+
+# copies the results of the names kept to the names dropped by deduplicate
+def fan_out(results, copies):
+    for name, names in copies.items():
+        if name in results:
+            for copy in names:
+                results[copy] = results[name]
+    return results
+
+
+# loaders map names to callables returning their results, called on first access only, so that results
+# never read, like cached entries of speculative batches, are not deserialized at all
 class MultiResult(object):
 
-    def __init__(self, results):
-        self.results = results
+    def __init__(self, results, loaders=None):
+        self._results = results
+        self._loaders = loaders or {}
+
+    def _result(self, key):
+        try:
+            return self._results[key]
+        except KeyError:
+            loader = self._loaders.pop(key, None)
+            if loader is None:
+                raise
+            result = self._results[key] = loader()
+            return result
+
+    # all the results, loaded
+    @property
+    def results(self):
+        for key in list(self._loaders.keys()):
+            self._result(key)
+        return self._results
 
     def __getitem__(self, key):
         try:
-            return self.results[key].return_result()
+            return self._result(key).return_result()
         except KeyError as e:
             raise ExecutionException('failed to find key "%s" in %s: %s' % (key, self, e))
 
     def get_result(self, key, throw_if_exception=True):
-        result = self.results[key]
+        result = self._result(key)
         if throw_if_exception:
             result.throw_if_exception()
         return result
 
+    def __contains__(self, key):
+        return key in self._results or key in self._loaders
+
     def items(self):
         return self.results.items()
 
     def keys(self):
-        return self.results.keys()
+        return list(self._results.keys()) + list(self._loaders.keys())
+
+
+# lazy objects created while a batch is active are queued in it; accessing any of them resolves all queued objects
+# of the same multi function with a single multi() call, instead of calling single() for each of them in turn
+class LazyBatch(object):
+
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, lazy):
+        with self.lock:
+            self.pending.setdefault(lazy._factory.multi_func, []).append(lazy)
+
+    # resolves the objects queued for multi_func, or all of them, with the multi functions called concurrently
+    def flush(self, multi_func=None):
+        with self.lock:
+            if multi_func is None:
+                lazy_objects = [lazy for group in self.pending.values() for lazy in group]
+                self.pending.clear()
+            else:
+                lazy_objects = self.pending.pop(multi_func, [])
+        if lazy_objects:
+            multi_lazy_resolve(lazy_objects, final_throw_if_any=False)
+
+    def __len__(self):
+        return sum(len(lazy_objects) for lazy_objects in self.pending.values())
+
+
+_lazy_batches = threading.local()
+
+
+def get_lazy_batch():
+    return getattr(_lazy_batches, 'batch', None)
+
+
+def activate_lazy_batch():
+    batch = _lazy_batches.batch = LazyBatch()
+    return batch
+
+
+# objects still queued are left to resolve on their own
+def deactivate_lazy_batch():
+    _lazy_batches.batch = None
+
+
+@contextmanager
+def lazy_batching():
+    old = get_lazy_batch()
+    try:
+        yield activate_lazy_batch()
+    finally:
+        _lazy_batches.batch = old
+
+
+def flush_lazy_batch(multi_func=None):
+    batch = get_lazy_batch()
+    if batch is not None:
+        batch.flush(multi_func)
+
+
+# with pickle_result set, filled lazy objects are pickled along with their results and come back filled,
+# instead of being resolved again after unpickling
+LAZY_PICKLE_RESULT = getattr(settings, 'SURROUND_LAZY_PICKLE_RESULT', False)
 
 
 class LazyFactory(object):
 
-    def __init__(self, class_owner, multi_func_name, const_attributes={}):
+    # for factories unpickled from entries stored by earlier releases
+    pickle_result = False
+
+    def __init__(self, class_owner, multi_func_name, const_attributes={}, pickle_result=None):
         self.class_owner = class_owner
         self.multi_func_name = multi_func_name
         self.const_attributes = const_attributes
+        self.pickle_result = pickle_result if pickle_result is not None else LAZY_PICKLE_RESULT
 
     @property
     def multi_func(self):
@@ -118,11 +274,16 @@ class LazyFactory(object):
 
 class LazyObject(object):
 
+    _batch = None
+
     def __init__(self, factory, parameters, const_attributes):
         self._factory = factory
         self._parameters = parameters
         self._execution_result = None
         self._const_attributes = const_attributes
+        self._batch = get_lazy_batch()
+        if self._batch is not None:
+            self._batch.add(self)
 
         for k, v in parameters.kwargs.items():
             setattr(self, k, v)
@@ -140,6 +301,8 @@ class LazyObject(object):
 
     @property
     def _auto_filled(self):
+        if not self._filled and self._batch is not None:
+            self._batch.flush(self._factory.multi_func)
         if not self._filled:
             # import traceback ; traceback.print_stack()
             self._fill(self._factory.multi_func.single(self._parameters))
@@ -164,19 +327,61 @@ class LazyObject(object):
     __repr__ = __str__
 
     def __reduce__(self):
+        if self._filled and self._factory.pickle_result:
+            # trailing defaults are left out, the factory gets memoized by pickle and brings the const attributes
+            restore_args = (self._factory, tuple(self._parameters.args), self._execution_result.value,
+                            self._execution_result.exception, self._parameters.kwargs)
+            if not self._parameters.kwargs:
+                restore_args = restore_args[:-1] if self._execution_result.exception is not None else restore_args[:-2]
+            return (_filled_lazy_object, restore_args)
         return (self.__class__, (self._factory, self._parameters, self._const_attributes))
 
     def __dir__(self):
         return dir(self._auto_filled)
 
 
+# lazy objects pickled with their results, see LazyObject.__reduce__
+def _filled_lazy_object(factory, args, value, exception=None, kwargs=None):
+    lazy = LazyObject(factory, Parameters(args, kwargs or {}), factory.const_attributes)
+    lazy._fill(Result(value, exception))
+    return lazy
+
+
+def _resolve_group(multi_func, multi_parameters):
+    return multi_func.multi(multi_parameters)
+
+
+# the thread gets the context cache and lazy batch of the caller, but database connections of its own;
+# map_concurrently calls some of the groups in the calling thread, which keeps its own state
+def _resolve_group_in_thread(caller, batch, group):
+    if threading.current_thread() is caller:
+        return execute(_resolve_group, Parameters(group, {}))
+    _lazy_batches.batch = batch
+    try:
+        return execute(_resolve_group, Parameters(group, {}))
+    finally:
+        _lazy_batches.batch = None
+        for connection in connections.all():
+            connection.close()
+
+
+# the groups run one after another in the calling thread under coroutine.simple, and inside transactions,
+# whose writes the connections of other threads would not see
+def _resolve_concurrently():
+    if settings.SURROUND_COROUTINE_IMPLEMENTATION_MODULE == 'surround.django.coroutine.simple':
+        return False
+    return not any(connection.in_atomic_block for connection in connections.all())
+
+
+# lazy objects of different multi functions are resolved with one multi() call per function, made concurrently in
+# threads of their own rather than with the coroutine implementation, since the groups are not picklable and each
+# multi() may batch its calls further; every object gets filled before the first failure is raised
 def multi_lazy_resolve(lazy_objects, final_throw_if_any=True, accumulate_successes=False):
 
-    multi_parameters = MultiParameters()
-    multi_func = None
+    groups = []
+    group_numbers = {}
 
     not_filled = []
-    not_filled_number = 0
     if accumulate_successes:
         successes = []
     else:
@@ -188,32 +393,42 @@ def multi_lazy_resolve(lazy_objects, final_throw_if_any=True, accumulate_success
                 successes.append(lazy._filled_value)
             continue
 
-        not_filled.append(lazy)
-        multi_parameters.add(not_filled_number, lazy._parameters)
-        not_filled_number += 1
+        multi_func = lazy._factory.multi_func
+        if multi_func not in group_numbers:
+            group_numbers[multi_func] = len(groups)
+            groups.append((multi_func, MultiParameters()))
+        group_number = group_numbers[multi_func]
+        multi_parameters = groups[group_number][1]
+        not_filled.append((lazy, group_number, len(multi_parameters)))
+        multi_parameters.add(len(multi_parameters), lazy._parameters)
 
-        next_multi_func = lazy._factory.multi_func
-        if multi_func is None:
-            multi_func = next_multi_func
-        else:
-            if multi_func != next_multi_func:
-                raise ExecutionException('inconsistent multi functions stored in lazy objects')
-
-    if multi_func is None:
+    if not groups:
         return successes
 
-    multi_results = multi_func.multi(multi_parameters)
-
-    for num, lazy in enumerate(not_filled):
-        result = multi_results.get_result(num, throw_if_exception=False)
+    if len(groups) == 1 or not _resolve_concurrently():
+        group_results = [execute(_resolve_group, Parameters(group, {})) for group in groups]
+    else:
+        resolve = partial(_resolve_group_in_thread, threading.current_thread(), get_lazy_batch())
+        group_results = map_concurrently(context_cache.wrap_with_current(resolve), groups)
+
+    first_failure = None
+    for lazy, group_number, num in not_filled:
+        group_result = group_results[group_number]
+        if group_result.success:
+            result = group_result.value.get_result(num, throw_if_exception=False)
+        else:
+            # the whole multi call of the group failed
+            result = group_result
         lazy._fill(result)
 
         if result.success:
             if accumulate_successes:
                 successes.append(lazy._filled_value)
-        else:
-            if final_throw_if_any:
-                result.throw_if_exception()
+        elif first_failure is None:
+            first_failure = result
+
+    if final_throw_if_any and first_failure is not None:
+        first_failure.throw_if_exception()
 
     return successes
 
@@ -0,0 +1,112 @@
+from __future__ import absolute_import
+from bisect import bisect_left
+import threading
+
+# Counters are updated without locking to keep the overhead low; under concurrent updates from many threads
+# a few increments may get lost, which is acceptable for the statistics gathered here.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # cumulative counts per upper bound, the last one being infinity
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            yield bound, total
+
+    def as_dict(self):
+        return dict(buckets=list(self.cumulative()), sum=self.sum, count=self.count)
+
+
+class ProxyMetrics(object):
+
+    # collapsed counts calls of a batch not made, since they duplicated other calls of the batch
+    counters = ('hits', 'misses', 'exceptions_cached', 'collapsed')
+    histograms = ('redis_latency', 'compute_latency', 'entry_size')
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.exceptions_cached = 0
+        self.collapsed = 0
+        self.redis_latency = Histogram(LATENCY_BUCKETS)
+        self.compute_latency = Histogram(LATENCY_BUCKETS)
+        self.entry_size = Histogram(SIZE_BUCKETS)
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else None
+
+    def as_dict(self):
+        result = {name: getattr(self, name) for name in self.counters}
+        result.update({name: getattr(self, name).as_dict() for name in self.histograms})
+        result['hit_ratio'] = self.hit_ratio
+        return result
+
+    def __str__(self):
+        return 'ProxyMetrics(%s, %d hits, %d misses)' % (self.name, self.hits, self.misses)
+
+
+class Registry(object):
+
+    prefix = 'surround_cache'
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            try:
+                return self.metrics[name]
+            except KeyError:
+                metrics = self.metrics[name] = ProxyMetrics(name)
+                return metrics
+
+    def snapshot(self):
+        return {name: metrics.as_dict() for name, metrics in self.metrics.items()}
+
+    def reset(self):
+        with self.lock:
+            for name in list(self.metrics.keys()):
+                self.metrics[name].__init__(name)
+
+    # prometheus text exposition format, version 0.0.4
+    def prometheus(self):
+        lines = []
+        metrics = sorted(self.metrics.values(), key=lambda m: m.name)
+        for counter in ProxyMetrics.counters:
+            metric = '%s_%s_total' % (self.prefix, counter)
+            lines.append('# TYPE %s counter' % metric)
+            for m in metrics:
+                lines.append('%s{proxy="%s"} %s' % (metric, m.name, getattr(m, counter)))
+        for histogram in ProxyMetrics.histograms:
+            metric = '%s_%s' % (self.prefix, histogram + ('_bytes' if histogram == 'entry_size' else '_seconds'))
+            lines.append('# TYPE %s histogram' % metric)
+            for m in metrics:
+                h = getattr(m, histogram)
+                for bound, count in h.cumulative():
+                    lines.append('%s_bucket{proxy="%s",le="%s"} %s' % (metric, m.name, bound, count))
+                lines.append('%s_sum{proxy="%s"} %s' % (metric, m.name, h.sum))
+                lines.append('%s_count{proxy="%s"} %s' % (metric, m.name, h.count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
@@ -0,0 +1,114 @@
+from __future__ import absolute_import
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+import threading
+import time
+
+
+# count-min sketch of recent access frequencies, halved every sample_size increments, so that old popularity fades
+class FrequencySketch(object):
+
+    max_count = 15
+
+    def __init__(self, width, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = [[0] * width for _ in range(depth)]
+        self.sample_size = 10 * width
+        self.additions = 0
+
+    def _indexes(self, key):
+        return [hash((seed, key)) % self.width for seed in range(self.depth)]
+
+    def increment(self, key):
+        for row, index in zip(self.table, self._indexes(key)):
+            if row[index] < self.max_count:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self._reset()
+
+    def _reset(self):
+        for row in self.table:
+            for index in range(self.width):
+                row[index] >>= 1
+        self.additions //= 2
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.table, self._indexes(key)))
+
+
+# bounded, thread safe LRU cache with per entry TTL; with admission enabled it works as TinyLFU:
+# a new key is admitted only if it is accessed at least as often as the least recently used one it would evict
+class LocalCache(object):
+
+    def __init__(self, maxsize, timeout, admission=False):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.sketch = FrequencySketch(max(16, maxsize)) if admission else None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            if self.sketch is not None:
+                self.sketch.increment(key)
+            try:
+                expires, value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires <= time.time():
+                self.misses += 1
+                return None
+            self.entries[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def _set(self, key, value, timeout):
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        if self.entries.pop(key, None) is None and len(self.entries) >= self.maxsize:
+            victim = next(iter(self.entries))
+            if self.sketch is not None and self.sketch.estimate(key) < self.sketch.estimate(victim):
+                return False
+            del self.entries[victim]
+            self.evictions += 1
+        self.entries[key] = (time.time() + timeout, value)
+        return True
+
+    def set(self, key, value, timeout=None):
+        with self.lock:
+            return self._set(key, value, timeout)
+
+    # stores the value only if the key is missing or expired
+    def add(self, key, value, timeout=None):
+        with self.lock:
+            current = self.entries.get(key)
+            if current is not None and current[0] > time.time():
+                return False
+            return self._set(key, value, timeout)
+
+    def delete(self, key):
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+    def delete_matching(self, key_mask):
+        with self.lock:
+            keys = [key for key in self.entries if fnmatchcase(key, key_mask)]
+            for key in keys:
+                del self.entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @property
+    def stats(self):
+        return dict(size=len(self.entries), hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def __str__(self):
+        return 'LocalCache(%d/%d entries, %d hits, %d misses)' % (len(self.entries), self.maxsize, self.hits, self.misses)
@@ -0,0 +1,24 @@
+from django.conf import settings
+from surround.django import execution
+
+
+# lazy objects created while handling a request are resolved in batches, see execution.LazyBatch;
+# by default all queued objects are also resolved right before a template response gets rendered
+class LazyBatchingMiddleware(object):
+    def __init__(self):
+        self.flush_before_render = getattr(settings, 'SURROUND_LAZY_BATCH_FLUSH_BEFORE_RENDER', True)
+
+    def process_request(self, request):
+        execution.activate_lazy_batch()
+
+    def process_template_response(self, request, response):
+        if self.flush_before_render:
+            execution.flush_lazy_batch()
+        return response
+
+    def process_response(self, request, response):
+        execution.deactivate_lazy_batch()
+        return response
+
+    def process_exception(self, request, exception):
+        execution.deactivate_lazy_batch()
@@ -9,11 +9,11 @@ setupModuleLogger(globals())
 
 
 def execute(key, timeout, view_func, request, args, kwargs):
-    r = redis.get_connection()
     method_key = key + ':method:%s' % request.method.lower()
+    r = redis.get_connection(method_key)
     hits_key = method_key + ':obj.hits'
 
-    response = r.get(method_key)
+    response = redis.read(method_key, lambda replica: replica.get(method_key))
 
     if response is not None:
         response = pickle.loads(response)
@@ -42,8 +42,8 @@ def execute(key, timeout, view_func, request, args, kwargs):
     return response
 
 
-def purge(key_mask):
-    redis.purge(key_mask + ':method:*')
+def purge(key_mask, background=False):
+    return redis.purge(key_mask + ':method:*', background=background)
 
 
 def warm_cache(url):
@@ -0,0 +1,201 @@
+from __future__ import absolute_import
+from collections import deque
+import random
+import threading
+import time
+import uuid
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+from django.conf import settings
+from surround.django import context_cache
+
+from surround.django.logging import setupModuleLogger
+setupModuleLogger(globals())
+
+# Policies are called with the function and its arguments in place of the function itself, see with_policies.
+
+
+# retries calls failing with the exceptions listed in exceptions_include, given as (exception_types, retries)
+# pairs like the exceptions_include of cache proxies; the delays grow exponentially from backoff up to
+# max_backoff, with the given fraction of each of them randomized, so that retrying callers spread out
+class RetryPolicy(object):
+
+    def __init__(self, exceptions_include, backoff=0.1, max_backoff=5.0, multiplier=2.0, jitter=1.0):
+        self.exceptions_include = exceptions_include
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def retries(self, exception):
+        for exception_types, retries in self.exceptions_include:
+            if isinstance(exception, exception_types):
+                return retries
+        return 0
+
+    def delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * self.multiplier ** attempt)
+        return delay * (1.0 - self.jitter * random.random())
+
+    def __call__(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.retries(e):
+                    raise
+                delay = self.delay(attempt)
+                debug('retrying %s in %.3fs after %s', func, delay, e)
+                time.sleep(delay)
+                attempt += 1
+
+    def __repr__(self):
+        return 'RetryPolicy(%r, %r, %r)' % (self.exceptions_include, self.backoff, self.max_backoff)
+
+
+HEDGE_THREADS = getattr(settings, 'SURROUND_HEDGE_THREADS', 32)
+
+_executor = None
+_executor_lock = threading.Lock()
+_attempt = threading.local()
+
+
+# imported lazily, on python 2 the futures package is only needed once something gets hedged
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                from surround.django.coroutine.pool import LazyExecutor
+                _executor = LazyExecutor(lambda: ThreadPoolExecutor(max_workers=HEDGE_THREADS))
+    return _executor.get()
+
+
+# fires a second call when the first one takes longer than the quantile of the latencies observed recently and
+# takes whichever finishes first, its exception included; until min_samples latencies are known, the hedge is sent
+# after initial_delay, or not at all without it. The call left behind finishes in the background.
+#
+# calls that cannot be hedged run in the calling thread, hedged ones on a pool of SURROUND_HEDGE_THREADS threads
+# shared by all policies of the process, while the caller waits for the first of them; the quantile is recomputed
+# once every refresh latencies. In the workers of coroutine.processes every worker learns latencies of its own.
+class HedgePolicy(object):
+
+    def __init__(self, quantile=0.95, min_delay=0.01, initial_delay=None, min_samples=20, window=1000, refresh=None):
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.window = window
+        self.refresh = refresh if refresh is not None else max(1, window // 20)
+        self.hedges = 0
+        # identifies the policy in the workers of coroutine.processes
+        self.key = uuid.uuid4().hex
+        self._reset()
+
+    def _reset(self):
+        self.latencies = deque(maxlen=self.window)
+        self._delay = None
+        self._observed = 0
+
+    def _observe(self, latency):
+        self.latencies.append(latency)
+        self._observed += 1
+
+    def delay(self):
+        if len(self.latencies) < self.min_samples:
+            return self.initial_delay
+        if self._delay is None or self._observed >= self.refresh:
+            self._observed = 0
+            latencies = sorted(self.latencies)
+            self._delay = max(self.min_delay, latencies[min(len(latencies) - 1, int(self.quantile * len(latencies)))])
+        return self._delay
+
+    def __call__(self, func, *args, **kwargs):
+        delay = self.delay()
+        # calls made from an attempt are not hedged, waiting for the pool from inside of it could exhaust it
+        if delay is None or getattr(_attempt, 'active', False):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._observe(time.time() - start)
+
+        finished = Queue()
+
+        def run():
+            _attempt.active = True
+            start = time.time()
+            try:
+                outcome = (func(*args, **kwargs), None)
+            except Exception as e:
+                outcome = (None, e)
+            self._observe(time.time() - start)
+            finished.put(outcome)
+
+        executor = _get_executor()
+        call = context_cache.wrap_with_current(run)
+        executor.submit(call)
+        try:
+            value, exception = finished.get(timeout=delay)
+        except Empty:
+            self.hedges += 1
+            executor.submit(call)
+            value, exception = finished.get()
+        if exception is not None:
+            raise exception
+        return value
+
+    # only the configuration is pickled, for the workers of coroutine.processes, where the chunks of a worker
+    # share a single instance of the policy
+    def __reduce__(self):
+        state = dict((k, v) for k, v in self.__dict__.items() if k not in ('latencies', '_delay', '_observed'))
+        return (_shared_hedge_policy, (self.key, state))
+
+    def __repr__(self):
+        return 'HedgePolicy(%r, %r)' % (self.quantile, self.min_delay)
+
+
+_shared_hedge_policies = {}
+
+def _shared_hedge_policy(key, state):
+    policy = _shared_hedge_policies.get(key)
+    if policy is None:
+        policy = HedgePolicy.__new__(HedgePolicy)
+        policy.__dict__.update(state)
+        policy._reset()
+        policy = _shared_hedge_policies.setdefault(key, policy)
+    return policy
+
+
+# the function called through the policies, the first of them being the outermost
+class PolicyFunction(object):
+
+    def __init__(self, func, policies):
+        self.func = func
+        self.policies = policies
+        self.__module__ = func.__module__
+        self.__name__ = getattr(func, '__name__', func.__class__.__name__)
+
+    def __call__(self, *args, **kwargs):
+        call = self.func
+        for policy in reversed(self.policies):
+            call = _bind(policy, call)
+        return call(*args, **kwargs)
+
+    def __repr__(self):
+        return 'PolicyFunction(%r, %r)' % (self.func, self.policies)
+
+
+def _bind(policy, func):
+    return lambda *args, **kwargs: policy(func, *args, **kwargs)
+
+
+def with_policies(func, policies):
+    policies = [policy for policy in policies or () if policy is not None]
+    if not policies:
+        return func
+    return PolicyFunction(func, policies)
@@ -1,60 +1,577 @@
 from __future__ import absolute_import
 from redis_cache import get_redis_connection
-import pickle
 import redis
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from surround.django.utils import CacheKey
 from surround.django import execution
+from surround.django import context_cache
+from surround.django.local_cache import LocalCache
+from surround.django.storage import StorageBackend
+from surround.django.policies import with_policies
+from surround.django import serialization
+from surround.django import instrumentation
+from surround.django.sharding import HashRing, map_concurrently
+from collections import namedtuple
+import calendar
 import datetime
+import os
+import inspect
+import itertools
+import math
+import random
+import threading
+import time
+import uuid
 from redis import WatchError
 
 from surround.django.logging import setupModuleLogger
 setupModuleLogger(globals())
 
+default_serializer = serialization.get_serializer()
+
 def set_pickled(self, key, value):
-    self.set(key, pickle.dumps(value))
+    self.set(key, default_serializer.dumps(value))
 
 def get_pickled(self, key):
-    obj = self.get(key)
+    name = _primary_name(self)
+    if name is not None:
+        obj = read_from(name, lambda r: r.get(key))
+    else:
+        obj = self.get(key)
     if obj is None:
         return None
-    return pickle.loads(obj)
+    return serialization.loads(obj)
 
 redis.StrictRedis.set_pickled = set_pickled
 redis.StrictRedis.get_pickled = get_pickled
 
-def get_connection():
-    connection = get_redis_connection('redis')
+DEFAULT_CONNECTION = 'redis'
+# names of redis connections the keys are distributed among; the default connection is still used for pub/sub
+SHARDS = getattr(settings, 'SURROUND_REDIS_SHARDS', None)
+SHARD_VIRTUAL_NODES = getattr(settings, 'SURROUND_REDIS_SHARD_VIRTUAL_NODES', 64)
+
+ring = HashRing(SHARDS, SHARD_VIRTUAL_NODES) if SHARDS else None
+
+def connection_name(key=None):
+    if ring is None or key is None:
+        return DEFAULT_CONNECTION
+    return ring.get_node(key)
+
+def connection_names():
+    if ring is None:
+        return [DEFAULT_CONNECTION]
+    return ring.nodes
+
+# groups a dict of name -> key by the names of the connections holding the keys
+def group_keys(keys):
+    if ring is None:
+        return {DEFAULT_CONNECTION: dict(keys)} if keys else {}
+    return ring.group(keys)
+
+# groups (key, ...) items by the connection names of their keys
+def group_items(items):
+    groups = {}
+    for item in items:
+        groups.setdefault(connection_name(item[0]), []).append(item)
+    return groups
+
+
+def get_connection(key=None):
+    connection = get_redis_connection(connection_name(key))
     return connection
 
+def get_connections():
+    return [get_redis_connection(name) for name in connection_names()]
+
+# primary connection name -> names of connections of its replicas, used for reads only
+REPLICAS = getattr(settings, 'SURROUND_REDIS_REPLICAS', {})
+# in seconds since the last interaction of the replica with its primary
+REPLICA_MAX_STALENESS = getattr(settings, 'SURROUND_REDIS_REPLICA_MAX_STALENESS', 10)
+REPLICA_CHECK_INTERVAL = getattr(settings, 'SURROUND_REDIS_REPLICA_CHECK_INTERVAL', 5)
+
+
+# picks replicas round robin, skipping the ones lagging too much or failing; the replication state
+# of each replica is checked at most once per check_interval
+class ReplicaPool(object):
+
+    def __init__(self, primary, replicas, check_interval=None):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.check_interval = check_interval if check_interval is not None else REPLICA_CHECK_INTERVAL
+        self._states = {}
+        self._counter = itertools.count()
+
+    # seconds of lag, or None if the replica is not usable
+    def _lag(self, name):
+        now = time.time()
+        checked_at, lag = self._states.get(name, (None, None))
+        if checked_at is None or now - checked_at > self.check_interval:
+            try:
+                info = get_redis_connection(name).info('replication')
+                lag = info.get('master_last_io_seconds_ago') if info.get('master_link_status') == 'up' else None
+            except redis.RedisError as e:
+                warning('checking replica %s of %s failed: %s', name, self.primary, e)
+                lag = None
+            self._states[name] = (now, lag)
+        return lag
+
+    def mark_down(self, name):
+        self._states[name] = (time.time(), None)
+
+    def choose(self, max_staleness):
+        start = next(self._counter)
+        for offset in range(len(self.replicas)):
+            name = self.replicas[(start + offset) % len(self.replicas)]
+            lag = self._lag(name)
+            if lag is not None and lag <= max_staleness:
+                return name
+        return None
+
+    def __repr__(self):
+        return 'ReplicaPool(%r, %r)' % (self.primary, self.replicas)
+
+
+_replica_pools = {primary: ReplicaPool(primary, replicas) for primary, replicas in REPLICAS.items()}
+
+def _primary_name(client):
+    for name in _replica_pools:
+        if get_redis_connection(name).connection_pool is client.connection_pool:
+            return name
+    return None
+
+# calls func with a replica of the named primary if one is fresh enough, falling back to the primary itself
+def read_from(name, func, max_staleness=None):
+    pool = _replica_pools.get(name)
+    if pool is not None:
+        replica = pool.choose(max_staleness if max_staleness is not None else REPLICA_MAX_STALENESS)
+        if replica is not None:
+            try:
+                return func(get_redis_connection(replica))
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                warning('reading from replica %s of %s failed: %s', replica, name, e)
+                pool.mark_down(replica)
+    return func(get_redis_connection(name))
+
+def read(key, func, max_staleness=None):
+    return read_from(connection_name(key), func, max_staleness)
+
+
+PURGE_SCAN_COUNT = getattr(settings, 'SURROUND_REDIS_PURGE_SCAN_COUNT', 1000)
+PURGE_BATCH_SIZE = getattr(settings, 'SURROUND_REDIS_PURGE_BATCH_SIZE', 500)
+PURGE_PIPELINE_DEPTH = getattr(settings, 'SURROUND_REDIS_PURGE_PIPELINE_DEPTH', 8)
+# UNLINK reclaims memory in a background thread of redis (>= 4.0), use DEL for older servers
+PURGE_COMMAND = getattr(settings, 'SURROUND_REDIS_PURGE_COMMAND', 'UNLINK')
+
+
+def _delete_keys(r, keys):
+    return r.execute_command(PURGE_COMMAND, *keys)
+
+
+# removes all keys matching key_mask, walking the keyspace incrementally with SCAN instead of blocking
+# redis with KEYS; matching keys are removed in batches, several batches per pipeline round trip
+class PurgeJob(object):
+
+    def __init__(self, key_mask, count=None, batch_size=None, pipeline_depth=None, progress=None):
+        self.key_mask = key_mask
+        self.count = count if count is not None else PURGE_SCAN_COUNT
+        self.batch_size = batch_size if batch_size is not None else PURGE_BATCH_SIZE
+        self.pipeline_depth = pipeline_depth if pipeline_depth is not None else PURGE_PIPELINE_DEPTH
+        self.progress = progress
+        self.scanned = 0
+        self.deleted = 0
+        self.done = False
+        self.exception = None
+        self._thread = None
+        # the shards are purged concurrently, all of them counting into the same totals
+        self._lock = threading.Lock()
+
+    def _count(self, scanned, deleted=0):
+        with self._lock:
+            self.scanned += scanned
+            self.deleted += deleted
+
+    def _flush(self, pipe):
+        if len(pipe):
+            self._count(0, sum(pipe.execute()))
+            if self.progress is not None:
+                self.progress(self)
+
+    def _run_on(self, r):
+        pipe = r.pipeline(transaction=False)
+        batch = []
+        for key in r.scan_iter(match=self.key_mask, count=self.count):
+            batch.append(key)
+            if len(batch) >= self.batch_size:
+                self._count(len(batch))
+                _delete_keys(pipe, batch)
+                batch = []
+                if len(pipe) >= self.pipeline_depth:
+                    self._flush(pipe)
+        if batch:
+            self._count(len(batch))
+            _delete_keys(pipe, batch)
+        self._flush(pipe)
+
+    def run(self):
+        try:
+            map_concurrently(self._run_on, get_connections())
+        finally:
+            self.done = True
+        invalidate_local(self.key_mask)
+        return self.deleted
+
+    def _run_in_background(self):
+        try:
+            self.run()
+        except Exception as e:
+            self.exception = e
+            error('background purge of %s failed: %s', self.key_mask, e)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run_in_background, name='purge %s' % self.key_mask)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.done
+
+    def __str__(self):
+        return 'PurgeJob(%s, %d scanned, %d deleted%s)' % (self.key_mask, self.scanned, self.deleted, ', done' if self.done else '')
+
+
+class RedisScript(object):
+
+    def __init__(self, source):
+        self.source = source
+        self._script = None
+
+    # client may be a pipeline, in which case the script is queued as a part of it
+    def __call__(self, client, keys=[], args=[]):
+        if self._script is None:
+            self._script = client.register_script(self.source)
+        return self._script(keys=keys, args=args, client=client)
+
+
 # make_key cannot be used here, since the key is already in its final shape
-def purge(key_mask):
+def purge(key_mask, background=False, count=None, batch_size=None, pipeline_depth=None, progress=None):
     debug('purging redis: %s', key_mask)
-    r = get_connection()
     if '*' in key_mask:
-        count = 0
-        for k in r.keys(key_mask):
-            r.delete(k)
-            count += 1
-        return count
+        job = PurgeJob(key_mask, count=count, batch_size=batch_size, pipeline_depth=pipeline_depth, progress=progress)
+        if background:
+            return job.start()
+        return job.run()
     else:
-        return r.delete(key_mask)
+        deleted = _delete_keys(get_connection(key_mask), [key_mask])
+        invalidate_local(key_mask)
+        return deleted
+
+
+LOCAL_INVALIDATION_CHANNEL = getattr(settings, 'SURROUND_REDIS_LOCAL_INVALIDATION_CHANNEL', settings.INSTANCE_NAME + ':local_invalidation')
+LOCAL_TIMEOUT = getattr(settings, 'SURROUND_REDIS_LOCAL_TIMEOUT', 5)
+
+_local_caches = []
+_local_listener_pid = None
+_local_listener_lock = threading.Lock()
+
+
+def _evict_local(key_mask):
+    for local in _local_caches:
+        if '*' in key_mask:
+            local.delete_matching(key_mask)
+        else:
+            local.delete(key_mask)
+
+
+def _listen_local_invalidations():
+    while True:
+        try:
+            pubsub = get_connection().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(LOCAL_INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                key_masks = message['data']
+                if not isinstance(key_masks, str):
+                    key_masks = key_masks.decode('utf-8')
+                for key_mask in key_masks.split('\n'):
+                    _evict_local(key_mask)
+        except Exception as e:
+            # invalidations may have been lost while disconnected
+            error('listening for local cache invalidations failed: %s', e)
+            for local in _local_caches:
+                local.clear()
+            time.sleep(1)
+
+
+# started lazily and once per process, since threads do not survive forking of the workers
+def _ensure_local_listener():
+    global _local_listener_pid
+    if _local_listener_pid == os.getpid():
+        return
+    with _local_listener_lock:
+        if _local_listener_pid == os.getpid():
+            return
+        thread = threading.Thread(target=_listen_local_invalidations, name='local cache invalidations')
+        thread.daemon = True
+        thread.start()
+        _local_listener_pid = os.getpid()
 
 
+# evicts local copies of the matching keys in all processes on all nodes, whether this process has local caches
+# or not; all the masks are sent in one message, separated by newlines
+def invalidate_local(*key_masks):
+    if not key_masks:
+        return
+    for key_mask in key_masks:
+        _evict_local(key_mask)
+    get_connection().publish(LOCAL_INVALIDATION_CHANNEL, '\n'.join(key_masks))
 
 
+def _tag_key(tag):
+    return '%s:tag:%s' % (settings.INSTANCE_NAME, tag)
+
+# adds an entry key to the tag set; the ttl of the set is only ever extended, so that it outlives all its entries
+_tag_entry_script = RedisScript("""
+redis.call('SADD', KEYS[1], ARGV[1])
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+""")
+
+# done atomically, so that no entry can be tagged between reading and removing the tag set;
+# with sharding every shard keeps its own tag sets, holding the keys of the entries stored there
+_invalidate_tags_script = RedisScript("""
+local deleted = 0
+for _, tag in ipairs(KEYS) do
+    local members = redis.call('SMEMBERS', tag)
+    for i = 1, #members, 1000 do
+        deleted = deleted + redis.call(ARGV[1], unpack(members, i, math.min(i + 999, #members)))
+    end
+    redis.call(ARGV[1], tag)
+end
+return deleted
+""")
+
+def invalidate_tags(*tags):
+    if not tags:
+        return 0
+    tag_keys = [_tag_key(tag) for tag in tags]
+    deleted = sum(map_concurrently(lambda r: _invalidate_tags_script(r, keys=tag_keys, args=[PURGE_COMMAND]), get_connections()))
+    # local caches do not know the tags of their entries
+    invalidate_local('*')
+    debug('invalidation of tags %s resulted in %s objects removed', ', '.join(map(str, tags)), deleted)
+    return deleted
+
+
+
+
+
+SINGLE_FLIGHT_LOCK_SUFFIX = ':lock'
+# in milliseconds, should be longer than the slowest computation
+SINGLE_FLIGHT_LOCK_TIMEOUT = getattr(settings, 'SURROUND_REDIS_SINGLE_FLIGHT_LOCK_TIMEOUT', 10000)
+# in seconds, after which the waiting caller computes the value on its own
+SINGLE_FLIGHT_LOCK_WAIT = getattr(settings, 'SURROUND_REDIS_SINGLE_FLIGHT_LOCK_WAIT', 5.0)
+SINGLE_FLIGHT_POLL_INTERVAL = getattr(settings, 'SURROUND_REDIS_SINGLE_FLIGHT_POLL_INTERVAL', 0.05)
+
+_release_lock_script = RedisScript("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+# envelope of entries stored by proxies with stale_timeout or early_refresh_beta; fresh_until is an epoch
+# timestamp after which the entry is served stale while being refreshed, delta is the time it took to compute
+class CacheEntry(namedtuple('CacheEntry', ['result', 'fresh_until', 'delta'])):
+
+    __slots__ = ()
+
+    # XFetch: the longer the computation, the more likely the refresh starts before the entry gets stale
+    def needs_refresh(self, now, beta):
+        if beta:
+            now -= self.delta * beta * math.log(1.0 - random.random())
+        return now >= self.fresh_until
+
+
+WRITE_BATCH_SIZE = getattr(settings, 'SURROUND_REDIS_WRITE_BATCH_SIZE', 500)
+
+
+# storage of cache proxy entries in redis, sharded by key; writes are sent in pipelines of write_batch_size
+# per shard, all shards concurrently, and reads go to replicas fresh enough if replica_reads is set
+class RedisBackend(StorageBackend):
+
+    supports_tags = True
+
+    def __init__(self, write_batch_size=None, replica_reads=True, replica_max_staleness=None):
+        self.write_batch_size = write_batch_size if write_batch_size is not None else WRITE_BATCH_SIZE
+        self.replica_reads = replica_reads
+        self.replica_max_staleness = replica_max_staleness
+
+    def _read(self, connection, func, primary=False):
+        if primary or not self.replica_reads:
+            return func(get_redis_connection(connection))
+        return read_from(connection, func, self.replica_max_staleness)
+
+    # reads the keys of a single shard in one pipeline
+    def _get_shard(self, group, primary=False):
+        connection, keys = group
+
+        def get_all(r):
+            pipe = r.pipeline(transaction=False)
+            for key in keys:
+                pipe.get(key)
+            return pipe.execute()
+
+        return list(zip(keys, self._read(connection, get_all, primary)))
+
+    @staticmethod
+    def _group(keys):
+        return {connection: list(shard_keys) for connection, shard_keys in group_keys({key: key for key in keys}).items()}
+
+    @staticmethod
+    def _execute(pipes):
+        for pipe in pipes:
+            pipe.execute()
+
+    def get(self, key):
+        return self._read(connection_name(key), lambda r: r.get(key))
+
+    def get_many(self, keys, primary=False):
+        values = {}
+        for shard_values in map_concurrently(lambda group: self._get_shard(group, primary), self._group(keys).items()):
+            values.update(shard_values)
+        return [values[key] for key in keys]
+
+    def set_many_with_ttl(self, items, tags=None):
+        tags = tags or {}
+        shard_pipes = []
+        for connection, shard_items in group_items(items).items():
+            r = get_redis_connection(connection)
+            pipes = []
+            for offset in range(0, len(shard_items), self.write_batch_size):
+                pipe = r.pipeline(transaction=False)
+                for key, value, ttl in shard_items[offset:offset + self.write_batch_size]:
+                    pipe.set(key, value, ex=ttl)
+                    for tag_key in tags.get(key, ()):
+                        _tag_entry_script(pipe, keys=[tag_key], args=[key, ttl])
+                pipes.append(pipe)
+            shard_pipes.append(pipes)
+        map_concurrently(self._execute, shard_pipes)
+
+    # also evicts the local copies of the keys in all processes
+    def delete_many(self, keys):
+        groups = self._group(keys).items()
+        deleted = sum(map_concurrently(lambda group: _delete_keys(get_redis_connection(group[0]), group[1]), groups))
+        invalidate_local(*keys)
+        return deleted
+
+    def add_many_with_ttl(self, items):
+        added = {}
+        for connection, shard_items in group_items(items).items():
+            pipe = get_redis_connection(connection).pipeline(transaction=False)
+            for key, value, ttl in shard_items:
+                pipe.set(key, value, nx=True, px=int(ttl * 1000))
+            for item, stored in zip(shard_items, pipe.execute()):
+                added[item[0]] = bool(stored)
+        return [added[key] for key, value, ttl in items]
+
+    def release_locks(self, keys, token):
+        released = 0
+        for connection, shard_keys in self._group(keys).items():
+            pipe = get_redis_connection(connection).pipeline(transaction=False)
+            for key in shard_keys:
+                _release_lock_script(pipe, keys=[key], args=[token])
+            released += sum(pipe.execute())
+        return released
+
+    def __repr__(self):
+        return 'RedisBackend()'
+
+
+# dotted path of a StorageBackend class, instantiated once and shared by all proxies not given a storage;
+# by default each proxy stores its entries in redis
+STORAGE = getattr(settings, 'SURROUND_CACHE_STORAGE', None)
+
+_default_storage = []
+_default_storage_lock = threading.Lock()
+
+
+def default_storage():
+    with _default_storage_lock:
+        if not _default_storage:
+            from django.utils.module_loading import import_string
+            _default_storage.append(import_string(STORAGE)())
+        return _default_storage[0]
+
 
 class CommonCacheProxy(object):
 
-    def __init__(self, func, timeout, key, exceptions_include):
+    def __init__(self, func, timeout, key, exceptions_include, tags=None, single_flight=False, lock_timeout=None, lock_wait=None,
+                 stale_timeout=None, early_refresh_beta=None, local_size=None, local_timeout=None, local_admission=False,
+                 serializer=None, write_batch_size=None, write_behind=False, replica_reads=True, replica_max_staleness=None,
+                 storage=None, call_timeout=None, batch_timeout=None, retry=None, hedge=None):
         self.func = func
+        # the function wrapped with the hedge and retry policies, every hedged call being retried on its own
+        self.call_func = with_policies(func, [hedge, retry])
         self.timeout = timeout
         self.key = key
         self.exceptions_include = exceptions_include
+        self.metrics = instrumentation.registry.get('%s.%s' % (func.__module__, func.__name__))
+        self.tags = tags if tags is not None else []
+        self.single_flight = single_flight
+        self.lock_timeout = lock_timeout if lock_timeout is not None else SINGLE_FLIGHT_LOCK_TIMEOUT
+        self.lock_wait = lock_wait if lock_wait is not None else SINGLE_FLIGHT_LOCK_WAIT
+        self.stale_timeout = stale_timeout
+        self.early_refresh_beta = early_refresh_beta
+        self.serializer = serialization.get_serializer(serializer) if serializer is not None else default_serializer
+        self.write_batch_size = write_batch_size if write_batch_size is not None else WRITE_BATCH_SIZE
+        self.write_behind = write_behind
+        self.replica_reads = replica_reads
+        self.replica_max_staleness = replica_max_staleness
+        self.call_timeout = call_timeout
+        self.batch_timeout = batch_timeout
+        if storage is not None:
+            self.storage = storage
+        elif STORAGE is not None:
+            self.storage = default_storage()
+        else:
+            self.storage = RedisBackend(self.write_batch_size, replica_reads, replica_max_staleness)
+        if self.tags and not self.storage.supports_tags:
+            raise ImproperlyConfigured('tags are not supported by the storage %r of %s' % (self.storage, self))
+        if local_size:
+            self.local = LocalCache(local_size, local_timeout if local_timeout is not None else LOCAL_TIMEOUT, admission=local_admission)
+            _local_caches.append(self.local)
+        else:
+            self.local = None
 
     def _key(self, args, kwargs):
         return self.key(*args, **kwargs)
 
+    def _call_arguments(self, args, kwargs):
+        arguments = inspect.getcallargs(self.func, *args, **kwargs)
+        arguments.update(kwargs)
+        return arguments
+
+    # tags are CacheKey patterns formatted with named arguments of the call, callables
+    # receiving the arguments of the call and returning a tag or a list of tags, or plain strings
+    def _tags(self, args, kwargs):
+        tags = []
+        for tag in self.tags:
+            if isinstance(tag, CacheKey):
+                value = tag(**self._call_arguments(args, kwargs))
+            elif callable(tag):
+                value = tag(*args, **kwargs)
+            else:
+                value = tag
+            if isinstance(value, (list, tuple, set)):
+                tags.extend(value)
+            elif value is not None:
+                tags.append(value)
+        return tags
+
 
     def purge(self, *args, **kwargs):
         return self.delete(*args, **kwargs)
@@ -63,16 +580,37 @@ class CommonCacheProxy(object):
         self.delete(*args, **kwargs)
         return self(*args, **kwargs)
 
+    # only set options are passed, so that implementations of execute_all without them keep working
+    def _execute_all_options(self):
+        options = {}
+        if self.call_timeout is not None:
+            options['timeout'] = self.call_timeout
+        if self.batch_timeout is not None:
+            options['deadline'] = time.time() + self.batch_timeout
+        return options
+
+    # calls not finished within call_timeout or batch_timeout seconds result in execution.TimeoutError,
+    # which is cached only if listed in exceptions_include
     def _multicall(self, multi):
         from surround.django import coroutine
-        return coroutine.execute_all(self.func, multi)
+        return coroutine.execute_all(self.call_func, multi, **self._execute_all_options())
 
     def multi(self, multi):
         return self._multicall(multi)
 
+    def multi_iter(self, multi):
+        from surround.django import coroutine
+        return coroutine.execute_iter(self.call_func, multi, **self._execute_all_options())
+
     def single(self, parameters):
         return execution.execute(self, parameters)
 
+    @property
+    def local_stats(self):
+        if self.local is None:
+            return None
+        return self.local.stats
+
     def compute_cache_timeout(self, entry):
         if entry.exception is None:
             return self.timeout
@@ -89,87 +627,380 @@ class CommonCacheProxy(object):
 
 class CacheProxy(CommonCacheProxy):
 
-    def _load_entry(self, pickled_entry):
-        return pickle.loads(pickled_entry)
+    # for plain data serializers entries are stored as (value, exception[, fresh_until, delta]) tuples
+    def _pack_entry(self, value):
+        if not self.serializer.plain_data:
+            return value
+        if isinstance(value, CacheEntry):
+            return (value.result.value, value.result.exception, value.fresh_until, value.delta)
+        return (value.value, value.exception)
+
+    def _unpack_entry(self, value):
+        if isinstance(value, (CacheEntry, execution.Result)):
+            return value
+        if len(value) == 4:
+            return CacheEntry(execution.Result(value[0], value[1]), value[2], value[3])
+        return execution.Result(value[0], value[1])
 
-    def _store_entry(self, r, key, entry):
+    @property
+    def _enveloped(self):
+        return self.stale_timeout is not None or bool(self.early_refresh_beta)
+
+    # when key and parameters are given, a stale entry schedules its refresh
+    # refresh is called in place of _refresh for entries needing one
+    def _load_entry(self, pickled_entry, key=None, parameters=None, refresh=None):
+        entry = self._unpack_entry(self.serializer.loads(pickled_entry))
+        if not isinstance(entry, CacheEntry):
+            return entry
+        if key is not None and entry.needs_refresh(time.time(), self.early_refresh_beta):
+            (refresh or self._refresh)(key, parameters)
+        return entry.result
+
+    # returns the (key, data, ttl) item to store, or None if the entry is not to be cached
+    def _prepare_entry(self, key, entry, delta):
         timeout = self.compute_cache_timeout(entry)
-        if timeout is not None:
-            r.set(key, pickle.dumps(entry))
-            r.expire(key, timeout)
+        if timeout is None:
+            return None
+        if self._enveloped:
+            value = CacheEntry(entry, time.time() + timeout, delta)
+            timeout += self.stale_timeout or 0
+        else:
+            value = entry
+        data = self.serializer.dumps(self._pack_entry(value))
+        self.metrics.entry_size.observe(len(data))
+        if entry.exception is not None:
+            self.metrics.exceptions_cached += 1
+        return key, data, timeout
+
+    # returns the items to store along with the tag keys of their entries
+    def _prepare_entries(self, keys, results, multi, delta):
+        items = []
+        tags = {}
+        for name, entry in results.items():
+            item = self._prepare_entry(keys[name], entry, delta)
+            if item is None:
+                continue
+            items.append(item)
+            if self.tags:
+                tags[item[0]] = [_tag_key(tag) for tag in self._tags(multi[name].args, multi[name].kwargs)]
+        return items, tags
+
+    # local copies are shared between callers, so cached values must not be mutated
+    def _get_local(self, key):
+        if self.local is None:
+            return None
+        # local copies are invalidated through redis pub/sub only
+        if isinstance(self.storage, RedisBackend):
+            _ensure_local_listener()
+        return self.local.get(key)
+
+    def _store_local(self, key, entry):
+        if self.local is not None:
+            timeout = self.compute_cache_timeout(entry)
+            if timeout is not None:
+                self.local.set(key, entry, timeout)
+
+    def _write(self, items, tags):
+        try:
+            start = time.time()
+            self.storage.set_many_with_ttl(items, tags)
+            self.metrics.redis_latency.observe(time.time() - start)
+        except Exception as e:
+            if not self.write_behind:
+                raise
+            error('write behind of %s failed: %s', self, e)
+
+    # all entries are written at once, in the background if write_behind is set
+    def _store_entries(self, keys, results, multi, delta=0.0):
+        items, tags = self._prepare_entries(keys, results, multi, delta)
+        if not items:
+            return
+        if self.write_behind:
+            thread = threading.Thread(target=self._write, args=(items, tags), name='write behind %s' % self)
+            thread.daemon = True
+            thread.start()
+        else:
+            self._write(items, tags)
+
+    def _store_entry(self, key, entry, parameters, delta=0.0):
+        multi = execution.MultiParameters()
+        multi.add(None, parameters)
+        self._store_entries({None: key}, {None: entry}, multi, delta)
+
+    def _compute(self, keys, multi):
+        start = time.time()
+        results = self._multicall(multi).results
+        delta = time.time() - start
+        self.metrics.compute_latency.observe(delta)
+        self._store_entries(keys, results, multi, delta)
+        return results
+
+    # recomputes the entry in a background thread, the lock makes sure only one caller in the cluster does it
+    def _refresh(self, key, parameters):
+        lock_key = key + SINGLE_FLIGHT_LOCK_SUFFIX
+        token = uuid.uuid4().hex
+        if not self.storage.acquire_locks([lock_key], token, self.lock_timeout / 1000.0)[0]:
+            return
 
+        def refresh():
+            try:
+                start = time.time()
+                result = execution.execute(self.call_func, parameters)
+                self._store_entry(key, result, parameters, time.time() - start)
+            except Exception as e:
+                error('refresh of %s in %s failed: %s', key, self, e)
+            finally:
+                self.storage.release_locks([lock_key], token)
+
+        debug('refreshing %s in %s', key, self)
+        thread = threading.Thread(target=context_cache.wrap_with_current(refresh), name='refresh %s' % key)
+        thread.daemon = True
+        thread.start()
+
+    # waits for other callers to store the entries, until their locks are gone or lock_wait passes
+    def _wait_for_entries(self, keys):
+        found = {}
+        pending = dict(keys)
+        deadline = time.time() + self.lock_wait
+        while pending and time.time() < deadline:
+            time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+            names = list(pending.keys())
+            entry_keys = [pending[name] for name in names]
+            # a replica lagging behind could show the lock released before the entry arrives, or the other way round
+            values = self.storage.get_many(entry_keys + [key + SINGLE_FLIGHT_LOCK_SUFFIX for key in entry_keys], primary=True)
+            for num, name in enumerate(names):
+                pickled_entry, lock = values[num], values[len(names) + num]
+                if pickled_entry is not None:
+                    found[name] = self._load_entry(pickled_entry)
+                    del pending[name]
+                elif lock is None:
+                    del pending[name]
+        return found
+
+    # only the caller holding the lock of a key computes it, the others wait for the stored entry
+    def _compute_single_flight(self, keys, multi):
+        token = uuid.uuid4().hex
+        owned = execution.MultiParameters()
+        waiting = {}
+        names = list(multi.keys())
+        lock_keys = [keys[name] + SINGLE_FLIGHT_LOCK_SUFFIX for name in names]
+        for name, lock in zip(names, self.storage.acquire_locks(lock_keys, token, self.lock_timeout / 1000.0)):
+            if lock:
+                owned.add(name, multi[name])
+            else:
+                waiting[name] = keys[name]
 
-    def multi(self, multi):
         results = {}
-        keys = {name: self._key(parameters.args, parameters.kwargs) for name, parameters in multi.items()}
+        if owned:
+            try:
+                results.update(self._compute(keys, owned))
+            finally:
+                self.storage.release_locks([keys[name] + SINGLE_FLIGHT_LOCK_SUFFIX for name in owned], token)
+
+        if waiting:
+            results.update(self._wait_for_entries(waiting))
+            remaining = execution.MultiParameters()
+            for name in waiting:
+                if name not in results:
+                    remaining.add(name, multi[name])
+            if remaining:
+                debug('single flight of %s: %d entries not stored by other callers in time', self, len(remaining))
+                results.update(self._compute(keys, remaining))
+
+        return results
+
+    def _compute_missing(self, keys, multi):
+        if self.single_flight:
+            return self._compute_single_flight(keys, multi)
+        return self._compute(keys, multi)
+
+    # names sharing a cache key are looked up and computed once, under the first of them; the other ones are
+    # removed from multi and returned as copies of the name kept
+    def _keys(self, multi):
+        keys = {}
+        copies = {}
+        kept = {}
+        for name, parameters in list(multi.items()):
+            key = self._key(parameters.args, parameters.kwargs)
+            if key in kept:
+                copies.setdefault(kept[key], []).append(name)
+                del multi[name]
+            else:
+                kept[key] = name
+                keys[name] = key
+        if copies:
+            self.metrics.collapsed += sum(len(names) for names in copies.values())
+        return keys, copies
+
+    # deserializes a stored entry on its first access, keeping its local copy from then on; names sharing
+    # the entry share the loader as well
+    def _entry_loader(self, key, pickled_entry, parameters, refresh=None):
+        loaded = []
+
+        def load():
+            if not loaded:
+                entry = self._load_entry(pickled_entry, key, parameters, refresh)
+                self._store_local(key, entry)
+                loaded.append(entry)
+            return loaded[0]
+
+        return load
+
+    # returns (name, entry) pairs found in the local cache or the storage, removing them from multi;
+    # with loaders given, the entries read from the storage are put there to be deserialized when accessed
+    def _find_entries(self, keys, multi, loaders=None):
+        found = []
+
+        if self.local is not None:
+            for name, key in list(keys.items()):
+                entry = self._get_local(key)
+                if entry is not None:
+                    found.append((name, entry))
+                    del multi[name]
+                    del keys[name]
+
+        names = list(keys.keys())
+        if not names:
+            return found
+        start = time.time()
+        pickled_entries = self.storage.get_many([keys[name] for name in names])
+        self.metrics.redis_latency.observe(time.time() - start)
+
+        for name, pickled_entry in zip(names, pickled_entries):
+            if pickled_entry is None:
+                continue
+            if loaders is not None:
+                loaders[name] = self._entry_loader(keys[name], pickled_entry, multi[name])
+            else:
+                entry = self._load_entry(pickled_entry, keys[name], multi[name])
+                self._store_local(keys[name], entry)
+                found.append((name, entry))
+            del multi[name]
+
+        return found
 
-        r = get_connection()
-        pipe = r.pipeline()
-        for key in keys.values():
-            pipe.get(key)
-        pickled_entries = pipe.execute()
+    def multi(self, multi):
+        keys, copies = self._keys(multi)
+        loaders = {}
+        results = dict(self._find_entries(keys, multi, loaders))
+        hits = len(results) + len(loaders)
 
-        hits = 0
-        misses = 0
+        missed_results = self._compute_missing(keys, multi) if multi else {}
+        misses = len(missed_results)
 
-        for name, pickled_entry in zip(keys.keys(), pickled_entries):
-            if pickled_entry is not None:
-                results[name] = self._load_entry(pickled_entry)
-                del multi[name]
-                hits += 1
+        for name, entry in missed_results.items():
+            self._store_local(keys[name], entry)
+        results.update(missed_results)
 
+        self.metrics.hits += hits
+        self.metrics.misses += misses
+        debug('called multi on %s: %d hits, %d misses, %d in total', self, hits, misses, hits + misses)
 
-        missed_results = self._multicall(multi)
+        return execution.MultiResult(execution.fan_out(results, copies), execution.fan_out(loaders, copies))
 
-        for name, entry in missed_results.results.items():
-            misses += 1
-            self._store_entry(r, keys[name], entry)
+    # yields (name, result) pairs as they become available: the cached ones first, then the computed ones in the
+    # order they finish; computed entries are stored once the iteration is over or abandoned
+    def multi_iter(self, multi):
+        keys, copies = self._keys(multi)
+        for name, entry in self._iter_entries(keys, multi):
+            yield name, entry
+            for copy in copies.get(name, ()):
+                yield copy, entry
 
-        results.update(missed_results.results)
+    def _iter_entries(self, keys, multi):
+        from surround.django import coroutine
+        found = self._find_entries(keys, multi)
+        self.metrics.hits += len(found)
+        for name, entry in found:
+            yield name, entry
 
-        debug('called multi on %s: %d hits, %d misses, %d in total', self, hits, misses, hits + misses)
+        if not multi:
+            return
+        if self.single_flight:
+            # waiting for the entries computed by other callers happens for the whole batch at once
+            for name, entry in self._compute_single_flight(keys, multi).items():
+                self._store_local(keys[name], entry)
+                self.metrics.misses += 1
+                yield name, entry
+            return
 
-        return execution.MultiResult(results)
+        computed = {}
+        start = time.time()
+        try:
+            for name, entry in coroutine.execute_iter(self.call_func, multi, **self._execute_all_options()):
+                computed[name] = entry
+                self._store_local(keys[name], entry)
+                self.metrics.misses += 1
+                yield name, entry
+        finally:
+            delta = time.time() - start
+            self.metrics.compute_latency.observe(delta)
+            self._store_entries(keys, computed, multi, delta)
+            debug('called multi_iter on %s: %d hits, %d misses', self, len(found), len(computed))
 
     def __call__(self, *args, **kwargs):
-        r = get_connection()
         key = self._key(args, kwargs)
-        pickled_entry = r.get(key)
+        entry = self._get_local(key)
+        if entry is not None:
+            self.metrics.hits += 1
+            return entry.return_result()
+
+        start = time.time()
+        pickled_entry = self.storage.get(key)
+        self.metrics.redis_latency.observe(time.time() - start)
+        parameters = execution.Parameters(args, kwargs)
         if pickled_entry is not None:
-            return self._load_entry(pickled_entry).return_result()
-
-        result = execution.execute(self.func, execution.Parameters(args, kwargs))
-        self._store_entry(r, key, result)
+            self.metrics.hits += 1
+            entry = self._load_entry(pickled_entry, key, parameters)
+            self._store_local(key, entry)
+            return entry.return_result()
+
+        self.metrics.misses += 1
+        if self.single_flight:
+            multi = execution.MultiParameters()
+            multi.add(None, parameters)
+            result = self._compute_single_flight({None: key}, multi)[None]
+        else:
+            start = time.time()
+            result = execution.execute(self.call_func, parameters)
+            delta = time.time() - start
+            self.metrics.compute_latency.observe(delta)
+            self._store_entry(key, result, parameters, delta)
 
+        self._store_local(key, result)
         return result.return_result()
 
     def delete(self, *args, **kwargs):
         key = self._key(args, kwargs)
-        deleted = purge(key)
+        deleted = self.storage.delete_many([key])
+        if self.local is not None:
+            self.local.delete(key)
         debug("delete of key %s resulted in %s objects removed", key, deleted)
         return deleted > 0
 
+
 class DummyCacheProxy(CommonCacheProxy):
 
     def __call__(self, *args, **kwargs):
-        return execution.execute(self.func, execution.Parameters(args, kwargs)).return_result()
+        return execution.execute(self.call_func, execution.Parameters(args, kwargs)).return_result()
 
     def delete(self, *args, **kwargs):
         return False
 
 
-def cache_result(timeout, key, exceptions_include=None):
+# see CommonCacheProxy for the available options
+def cache_result(timeout, key, exceptions_include=None, **options):
 
     def decorator(func):
-        return CacheProxy(func, timeout, key, exceptions_include)
+        return CacheProxy(func, timeout, key, exceptions_include, **options)
 
     return decorator
 
 
-def dummy_cache_result(timeout, key, exceptions_include=None):
+def dummy_cache_result(timeout, key, exceptions_include=None, **options):
 
     def decorator(func):
-        return DummyCacheProxy(func, timeout, key, exceptions_include)
+        return DummyCacheProxy(func, timeout, key, exceptions_include, **options)
 
     return decorator
 
@@ -215,6 +1046,96 @@ class ReferenceMonitorMetaclass(type):
 
         return super(ReferenceMonitorMetaclass, meta).__new__(meta, name, bases, attrs)
 
+# moments are stored as seconds since epoch; datetime_format strings, local time written by earlier releases
+# or with legacy moments, are converted with the utc offset in ARGV[3]
+_MOMENT_SECONDS_LUA = """
+local function seconds(moment)
+    if tonumber(moment) then
+        return tonumber(moment)
+    end
+    local y, m, d, H, M, S = string.match(moment, '(%d+)-(%d+)-(%d+)T(%d+):(%d+):(%d+)')
+    y, m, d = tonumber(y), tonumber(m), tonumber(d)
+    if m <= 2 then
+        y = y - 1
+    end
+    local era = math.floor(y / 400)
+    local yoe = y - era * 400
+    local doy = math.floor((153 * ((m + 9) % 12) + 2) / 5) + d - 1
+    local doe = yoe * 365 + math.floor(yoe / 4) - math.floor(yoe / 100) + doy
+    return (era * 146097 + doe - 719468) * 86400 + tonumber(H) * 3600 + tonumber(M) * 60 + tonumber(S) - tonumber(ARGV[3])
+end
+"""
+
+# KEYS are the monitor hash and the failing index; ARGV holds now in seconds, now as stored, the utc offset,
+# failure and success labels, followed by label, timeout and repeat timeout (negative if none) of each
+# notification; returns the first failure in seconds and the state of each notification: 0 - inactive,
+# 1 - active, 2 - active and to be sent now
+_mark_failure_script = RedisScript(_MOMENT_SECONDS_LUA + """
+local now = tonumber(ARGV[1])
+redis.call('HDEL', KEYS[1], ARGV[5])
+local first_failure
+if redis.call('HSETNX', KEYS[1], ARGV[4], ARGV[2]) == 1 then
+    first_failure = now
+    for i = 6, #ARGV, 3 do
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+else
+    first_failure = seconds(redis.call('HGET', KEYS[1], ARGV[4]))
+end
+redis.call('ZADD', KEYS[2], first_failure, KEYS[1])
+local states = {first_failure}
+for i = 6, #ARGV, 3 do
+    local state = 0
+    if now >= first_failure + tonumber(ARGV[i + 1]) then
+        state = 1
+        local last_failure = redis.call('HGET', KEYS[1], ARGV[i])
+        local repeat_timeout = tonumber(ARGV[i + 2])
+        if not last_failure or (repeat_timeout >= 0 and now > seconds(last_failure) + repeat_timeout) then
+            redis.call('HSET', KEYS[1], ARGV[i], ARGV[2])
+            state = 2
+        end
+    end
+    table.insert(states, state)
+end
+return states
+""")
+
+# KEYS are the monitor hash and the failing index; ARGV holds now as stored and success label, followed by labels
+# of the notifications; returns nothing if success was already marked, otherwise which notifications
+# were sent and are reset now
+_mark_success_script = RedisScript("""
+if redis.call('HSETNX', KEYS[1], ARGV[2], ARGV[1]) == 0 then
+    return {}
+end
+redis.call('ZREM', KEYS[2], KEYS[1])
+local reset = {}
+for i = 3, #ARGV do
+    table.insert(reset, redis.call('HDEL', KEYS[1], ARGV[i]))
+end
+return reset
+""")
+
+
+# moments are naive local datetimes, as returned by _now, and stored as seconds since epoch
+def _seconds(moment):
+    return int(time.mktime(moment.timetuple()))
+
+def _moment(seconds):
+    return datetime.datetime.fromtimestamp(int(seconds))
+
+def _utc_offset(moment):
+    return calendar.timegm(moment.timetuple()) - _seconds(moment)
+
+def _timeout_seconds(timeout):
+    return -1 if timeout is None else int(timeout.total_seconds())
+
+
+MONITOR_BATCH_SIZE = getattr(settings, 'SURROUND_REDIS_MONITOR_BATCH_SIZE', 500)
+# workers of releases storing moments as datetime_format strings fail to read seconds since epoch; moments
+# keep being written as strings while set, which both formats read, until all workers are upgraded
+MONITOR_LEGACY_MOMENTS = getattr(settings, 'SURROUND_REDIS_MONITOR_LEGACY_MOMENTS', False)
+
+
 class ReferenceMonitor(object):
 
     datetime_format = '%Y-%m-%dT%H:%M:%S'
@@ -228,14 +1149,25 @@ class ReferenceMonitor(object):
         self.kwargs = kwargs
         self._key_value = self.key(*self.args, **self.kwargs)
 
+    # datetime_format is only used for moments stored by earlier releases or with legacy moments
     def _get_moment(self, r, label):
         m = r.hget(self._key_value, label)
         if m is None:
             return None
-        return datetime.datetime.strptime(m, self.datetime_format)
+        try:
+            return _moment(m)
+        except ValueError:
+            if isinstance(m, bytes) and not isinstance(m, str):
+                m = m.decode('ascii')
+            return datetime.datetime.strptime(m, self.datetime_format)
+
+    def _stored_moment(self, moment):
+        if MONITOR_LEGACY_MOMENTS:
+            return moment.strftime(self.datetime_format)
+        return _seconds(moment)
 
     def _set_moment(self, r, label, moment, override=False):
-        return (r.hset if override else r.hsetnx)(self._key_value, label, moment.strftime(self.datetime_format))
+        return (r.hset if override else r.hsetnx)(self._key_value, label, self._stored_moment(moment))
 
     def _del_moment(self, r, label):
         return r.hdel(self._key_value, label)
@@ -247,44 +1179,104 @@ class ReferenceMonitor(object):
     def __str__(self):
         return '-'.join(list(self.args) + ['%s=%s' % (k, v) for k, v in self.kwargs.items()])
 
-    def mark_failure(self):
-        r = get_connection()
-        now = self._now()
-        self._del_moment(r, self.success_label)
-        if self._set_moment(r, self.failure_label, now):
-            _first_failure = now
-            # reset all notifications
-            for n in self._reference_monitor_notifications:
-                self._del_moment(r, n._label)
-        else:
-            _first_failure = self._get_moment(r, self.failure_label)
-
-        active_notifications = []
+    # the state transitions are done atomically by scripts, notifications are sent afterwards
+
+    # sorted set of keys of the failing monitors of the class, scored with their first failure
+    @classmethod
+    def _failing_index_key(cls):
+        return '%s:failing:%s.%s' % (settings.INSTANCE_NAME, cls.__module__, cls.__name__)
+
+    # keys and first failures of the monitors failing for at least longer_than seconds, in one round trip
+    @classmethod
+    def failing(cls, longer_than=0):
+        seconds = _seconds(cls._now()) - longer_than
+        index_key = cls._failing_index_key()
+        entries = []
+        # with sharding every shard indexes the monitors stored there
+        for shard_entries in map_concurrently(lambda r: r.zrangebyscore(index_key, '-inf', seconds, withscores=True), get_connections()):
+            entries.extend(shard_entries)
+        entries.sort(key=lambda entry: entry[1])
+        return [(key, _moment(first_failure)) for key, first_failure in entries]
+
+    def _mark_failure(self, client, now):
+        args = [_seconds(now), self._stored_moment(now), _utc_offset(now), self.failure_label, self.success_label]
         for n in self._reference_monitor_notifications:
-            if now >= _first_failure + n._timeout:
-                _last_failure = self._get_moment(r, n._label)
-                if _last_failure is None or ((n._repeat_timeout is not None) and (now > _last_failure + n._repeat_timeout)):
-                    self._set_moment(r, n._label, now, override=True)
-                    n._failure(self)
+            args.extend([n._label, _timeout_seconds(n._timeout), _timeout_seconds(n._repeat_timeout)])
+        return _mark_failure_script(client, keys=[self._key_value, self._failing_index_key()], args=args)
 
+    def _notify_failure(self, now, states):
+        active_notifications = []
+        for n, state in zip(self._reference_monitor_notifications, states[1:]):
+            if state == 2:
+                n._failure(self)
+            if state:
                 active_notifications.append(n)
 
-        return (now - _first_failure, active_notifications)
+        return (datetime.timedelta(seconds=_seconds(now) - states[0]), active_notifications)
 
-    def mark_success(self):
-        r = get_connection()
+    def _mark_success(self, client, now):
+        args = [self._stored_moment(now), self.success_label]
+        args.extend([n._label for n in self._reference_monitor_notifications])
+        return _mark_success_script(client, keys=[self._key_value, self._failing_index_key()], args=args)
+
+    def _notify_success(self, reset):
+        for n, was_sent in zip(self._reference_monitor_notifications, reset):
+            # it there was notification, send about success
+            if was_sent and n._success is not None:
+                n._success(self)
+
+    def mark_failure(self):
         now = self._now()
-        if not self._set_moment(r, self.success_label, now):
-            return
+        return self._notify_failure(now, self._mark_failure(get_connection(self._key_value), now))
 
-        # reset all notifications
-        for n in self._reference_monitor_notifications:
-            if self._del_moment(r, n._label):
-                # it there was notification, send about success
-                if n._success is not None:
-                    n._success(self)
+    def mark_success(self):
+        self._notify_success(self._mark_success(get_connection(self._key_value), self._now()))
+
+    # marks many monitors, possibly of different classes, with pipelines of batch_size scripts; notifications
+    # are sent once all transitions are done, a failing one is logged and does not stop the others;
+    # returns results of mark_failure for each of the failures
+    @staticmethod
+    def mark_many(successes=(), failures=(), batch_size=None):
+        batch_size = batch_size if batch_size is not None else MONITOR_BATCH_SIZE
+        now = ReferenceMonitor._now()
+        marks = [(monitor, True) for monitor in successes] + [(monitor, False) for monitor in failures]
+
+        shards = group_keys({num: monitor._key_value for num, (monitor, success) in enumerate(marks)})
+        replies = [None] * len(marks)
+
+        def mark_shard(shard):
+            connection, shard_keys = shard
+            r = get_redis_connection(connection)
+            nums = sorted(shard_keys.keys())
+            for start in range(0, len(nums), batch_size):
+                pipe = r.pipeline(transaction=False)
+                for num in nums[start:start + batch_size]:
+                    monitor, success = marks[num]
+                    if success:
+                        monitor._mark_success(pipe, now)
+                    else:
+                        monitor._mark_failure(pipe, now)
+                for num, reply in zip(nums[start:start + batch_size], pipe.execute()):
+                    replies[num] = reply
+
+        map_concurrently(mark_shard, shards.items())
+
+        results = []
+        for (monitor, success), reply in zip(marks, replies):
+            try:
+                if success:
+                    monitor._notify_success(reply)
+                else:
+                    results.append(monitor._notify_failure(now, reply))
+            except Exception as e:
+                error('notification of %s failed: %s', monitor, e)
+                if not success:
+                    results.append(None)
+        return results
 
     def cancel(self):
-        r = get_connection()
-        r.delete(self._key_value)
+        pipe = get_connection(self._key_value).pipeline()
+        pipe.delete(self._key_value)
+        pipe.zrem(self._failing_index_key(), self._key_value)
+        pipe.execute()
 
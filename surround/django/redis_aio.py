@@ -0,0 +1,287 @@
+import asyncio
+import time
+import uuid
+import weakref
+import redis.asyncio
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from surround.django import execution
+from surround.django import redis as sync_redis
+from redis_cache import get_redis_connection
+from surround.django.coroutine import aio
+
+from surround.django.logging import setupModuleLogger
+setupModuleLogger(globals())
+
+# asyncio counterpart of redis.cache_result for ASGI views, python 3 only; entries, keys and tags
+# are shared with the synchronous proxies, so both kinds can be used on the same data
+
+_connections = weakref.WeakKeyDictionary()
+
+_CONNECTION_KWARGS = ('host', 'port', 'db', 'password', 'socket_timeout', 'socket_connect_timeout')
+
+
+def _create_connection(name):
+    urls = getattr(settings, 'SURROUND_REDIS_ASYNC_URLS', {})
+    if name in urls:
+        return redis.asyncio.from_url(urls[name])
+    kwargs = get_redis_connection(name).connection_pool.connection_kwargs
+    connection_kwargs = {k: kwargs[k] for k in _CONNECTION_KWARGS if k in kwargs}
+    if 'path' in kwargs:
+        connection_kwargs['unix_socket_path'] = kwargs['path']
+    return redis.asyncio.Redis(**connection_kwargs)
+
+
+# asyncio connections are bound to their event loop; unless SURROUND_REDIS_ASYNC_URLS maps the connection name
+# to an url, the server of the synchronous connection of the same name is used
+def get_redis_async_connection(name):
+    connections = _connections.setdefault(asyncio.get_event_loop(), {})
+    try:
+        return connections[name]
+    except KeyError:
+        connection = connections[name] = _create_connection(name)
+        return connection
+
+
+def get_connection(key=None):
+    return get_redis_async_connection(sync_redis.connection_name(key))
+
+
+async def invalidate_local(*key_masks):
+    if not key_masks:
+        return
+    for key_mask in key_masks:
+        sync_redis._evict_local(key_mask)
+    await get_connection().publish(sync_redis.LOCAL_INVALIDATION_CHANNEL, '\n'.join(key_masks))
+
+
+class AsyncCacheProxy(sync_redis.CacheProxy):
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncCacheProxy, self).__init__(*args, **kwargs)
+        if self.single_flight:
+            raise ImproperlyConfigured('single flight is not supported by %s' % self)
+        if not isinstance(self.storage, sync_redis.RedisBackend):
+            raise ImproperlyConfigured('%s supports only redis storage' % self)
+        # policies block while waiting, which only works for functions run in the executor
+        if self.call_func is not self.func and asyncio.iscoroutinefunction(self.func):
+            raise ImproperlyConfigured('retry and hedge policies are not supported for coroutine functions by %s' % self)
+
+    async def _store_entries(self, keys, results, multi, delta=0.0):
+        items, tags = self._prepare_entries(keys, results, multi, delta)
+        shard_pipes = []
+        for connection, shard_items in sync_redis.group_items(items).items():
+            r = get_redis_async_connection(connection)
+            pipes = []
+            for offset in range(0, len(shard_items), self.write_batch_size):
+                pipe = r.pipeline(transaction=False)
+                for key, data, timeout in shard_items[offset:offset + self.write_batch_size]:
+                    pipe.set(key, data, ex=timeout)
+                    for tag_key in tags.get(key, ()):
+                        # scripts registered for the synchronous client cannot be queued in asyncio pipelines
+                        pipe.eval(sync_redis._tag_entry_script.source, 1, tag_key, key, timeout)
+                pipes.append(pipe)
+            shard_pipes.append(pipes)
+
+        if not shard_pipes:
+            return
+        if self.write_behind:
+            asyncio.ensure_future(self._execute_writes(shard_pipes))
+        else:
+            await self._execute_writes(shard_pipes)
+
+    async def _execute_writes(self, shard_pipes):
+        await asyncio.gather(*[self._execute_shard_writes(pipes) for pipes in shard_pipes])
+
+    async def _execute_shard_writes(self, pipes):
+        for pipe in pipes:
+            try:
+                start = time.time()
+                await pipe.execute()
+                self.metrics.redis_latency.observe(time.time() - start)
+            except Exception as e:
+                if not self.write_behind:
+                    raise
+                error('write behind of %s failed: %s', self, e)
+
+    async def _compute(self, keys, multi):
+        start = time.time()
+        results = (await aio.execute_all(self.call_func, multi, **self._execute_all_options())).results
+        delta = time.time() - start
+        self.metrics.compute_latency.observe(delta)
+        await self._store_entries(keys, results, multi, delta)
+        return results
+
+    # entries of multi() may be deserialized outside of the loop, in another thread or once it is finished,
+    # so their refreshes are scheduled on the loop multi() ran in; with the loop closed they are skipped
+    def _refresh(self, key, parameters, loop=None):
+        if loop is None:
+            asyncio.ensure_future(self._refresh_entry(key, parameters))
+        elif loop.is_closed():
+            debug('refresh of %s in %s skipped, its event loop is closed', key, self)
+        else:
+            asyncio.run_coroutine_threadsafe(self._refresh_entry(key, parameters), loop)
+
+    def _entry_loader(self, key, pickled_entry, parameters):
+        loop = asyncio.get_event_loop()
+        return super(AsyncCacheProxy, self)._entry_loader(key, pickled_entry, parameters,
+                                                          lambda key, parameters: self._refresh(key, parameters, loop))
+
+    async def _refresh_entry(self, key, parameters):
+        r = get_connection(key)
+        lock_key = key + sync_redis.SINGLE_FLIGHT_LOCK_SUFFIX
+        token = uuid.uuid4().hex
+        if not await r.set(lock_key, token, nx=True, px=self.lock_timeout):
+            return
+        try:
+            start = time.time()
+            result = await aio.execute(self.call_func, parameters)
+            multi = execution.MultiParameters()
+            multi.add(None, parameters)
+            await self._store_entries({None: key}, {None: result}, multi, time.time() - start)
+        except Exception as e:
+            error('refresh of %s in %s failed: %s', key, self, e)
+        finally:
+            await r.eval(sync_redis._release_lock_script.source, 1, lock_key, token)
+
+    @staticmethod
+    async def _read_shard(group):
+        connection, shard_keys = group
+        names = list(shard_keys.keys())
+        pipe = get_redis_async_connection(connection).pipeline(transaction=False)
+        for name in names:
+            pipe.get(shard_keys[name])
+        return list(zip(names, await pipe.execute()))
+
+    async def _find_entries(self, keys, multi, loaders=None):
+        found = []
+
+        if self.local is not None:
+            for name, key in list(keys.items()):
+                entry = self._get_local(key)
+                if entry is not None:
+                    found.append((name, entry))
+                    del multi[name]
+                    del keys[name]
+
+        if not keys:
+            return found
+        start = time.time()
+        pickled_entries = []
+        for shard_entries in await asyncio.gather(*[self._read_shard(group) for group in sync_redis.group_keys(keys).items()]):
+            pickled_entries.extend(shard_entries)
+        self.metrics.redis_latency.observe(time.time() - start)
+
+        for name, pickled_entry in pickled_entries:
+            if pickled_entry is None:
+                continue
+            if loaders is not None:
+                loaders[name] = self._entry_loader(keys[name], pickled_entry, multi[name])
+            else:
+                entry = self._load_entry(pickled_entry, keys[name], multi[name])
+                self._store_local(keys[name], entry)
+                found.append((name, entry))
+            del multi[name]
+
+        return found
+
+    async def multi(self, multi):
+        keys, copies = self._keys(multi)
+        loaders = {}
+        results = dict(await self._find_entries(keys, multi, loaders))
+        hits = len(results) + len(loaders)
+
+        missed_results = await self._compute(keys, multi) if multi else {}
+        misses = len(missed_results)
+
+        for name, entry in missed_results.items():
+            self._store_local(keys[name], entry)
+        results.update(missed_results)
+
+        self.metrics.hits += hits
+        self.metrics.misses += misses
+        debug('called multi on %s: %d hits, %d misses, %d in total', self, hits, misses, hits + misses)
+
+        return execution.MultiResult(execution.fan_out(results, copies), execution.fan_out(loaders, copies))
+
+    async def multi_iter(self, multi):
+        keys, copies = self._keys(multi)
+        async for name, entry in self._iter_entries(keys, multi):
+            yield name, entry
+            for copy in copies.get(name, ()):
+                yield copy, entry
+
+    async def _iter_entries(self, keys, multi):
+        found = await self._find_entries(keys, multi)
+        self.metrics.hits += len(found)
+        for name, entry in found:
+            yield name, entry
+
+        if not multi:
+            return
+        computed = {}
+        start = time.time()
+        try:
+            async for name, entry in aio.execute_iter(self.call_func, multi, **self._execute_all_options()):
+                computed[name] = entry
+                self._store_local(keys[name], entry)
+                self.metrics.misses += 1
+                yield name, entry
+        finally:
+            delta = time.time() - start
+            self.metrics.compute_latency.observe(delta)
+            await self._store_entries(keys, computed, multi, delta)
+
+    async def _get_result(self, args, kwargs):
+        key = self._key(args, kwargs)
+        entry = self._get_local(key)
+        if entry is not None:
+            self.metrics.hits += 1
+            return entry
+
+        r = get_connection(key)
+        start = time.time()
+        pickled_entry = await r.get(key)
+        self.metrics.redis_latency.observe(time.time() - start)
+        parameters = execution.Parameters(args, kwargs)
+        if pickled_entry is not None:
+            self.metrics.hits += 1
+            entry = self._load_entry(pickled_entry, key, parameters)
+        else:
+            self.metrics.misses += 1
+            multi = execution.MultiParameters()
+            multi.add(None, parameters)
+            entry = (await self._compute({None: key}, multi))[None]
+        self._store_local(key, entry)
+        return entry
+
+    async def __call__(self, *args, **kwargs):
+        return (await self._get_result(args, kwargs)).return_result()
+
+    async def single(self, parameters):
+        try:
+            return await self._get_result(parameters.args, parameters.kwargs)
+        except Exception as e:
+            if settings.SURROUND_EXECUTION_DEBUG:
+                raise
+            return execution.Result(None, e)
+
+    async def delete(self, *args, **kwargs):
+        key = self._key(args, kwargs)
+        deleted = await get_connection(key).execute_command(sync_redis.PURGE_COMMAND, key)
+        await invalidate_local(key)
+        debug("delete of key %s resulted in %s objects removed", key, deleted)
+        return deleted > 0
+
+    async def force(self, *args, **kwargs):
+        await self.delete(*args, **kwargs)
+        return await self(*args, **kwargs)
+
+
+# see CommonCacheProxy for the available options
+def acache_result(timeout, key, exceptions_include=None, **options):
+
+    def decorator(func):
+        return AsyncCacheProxy(func, timeout, key, exceptions_include, **options)
+
+    return decorator
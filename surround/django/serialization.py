@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+import marshal
+import pickle
+import zlib
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Serialized values start with a header byte identifying the format (low nibble) and the compression (high nibble).
+# None of the header bytes is a valid first byte of a pickle, so values stored without a header are still readable.
+
+PICKLE = 'pickle'
+MARSHAL = 'marshal'
+MSGPACK = 'msgpack'
+
+ZLIB = 'zlib'
+LZ4 = 'lz4'
+
+
+def _msgpack_dumps(value):
+    return msgpack.packb(value, use_bin_type=True)
+
+# maps are read back with keys of any type, like ints, as msgpack before 1.0 did; strict_map_key is only
+# known to msgpack since 0.6.1
+_MSGPACK_LOADS_KWARGS = {'strict_map_key': False} if msgpack is not None and msgpack.version >= (0, 6, 1) else {}
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False, **_MSGPACK_LOADS_KWARGS)
+
+# marshal format is specific to the python version, only use it when all workers run the same one
+_formats = {
+    PICKLE: (0x01, lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL), pickle.loads),
+    MARSHAL: (0x02, marshal.dumps, marshal.loads),
+    MSGPACK: (0x03, _msgpack_dumps, _msgpack_loads),
+}
+
+_compressions = {
+    None: (0x00, None, None),
+    ZLIB: (0x10, zlib.compress, zlib.decompress),
+    LZ4: (0x20, lambda data: lz4.frame.compress(data), lambda data: lz4.frame.decompress(data)),
+}
+
+_headers = {}
+for _format_id, _format_dumps, _format_loads in _formats.values():
+    for _compression_id, _compress, _decompress in _compressions.values():
+        _headers[_format_id | _compression_id] = (_format_loads, _decompress)
+
+
+def loads(data):
+    header = bytearray(data[:1])[0] if data else None
+    try:
+        format_loads, decompress = _headers[header]
+    except KeyError:
+        return pickle.loads(data)
+    data = data[1:]
+    if decompress is not None:
+        data = decompress(data)
+    return format_loads(data)
+
+
+class Serializer(object):
+
+    def __init__(self, format=PICKLE, compression=None, compress_threshold=1024):
+        if format not in _formats:
+            raise ImproperlyConfigured('unknown serialization format: %s' % format)
+        if compression not in _compressions:
+            raise ImproperlyConfigured('unknown compression: %s' % compression)
+        if format == MSGPACK and msgpack is None:
+            raise ImproperlyConfigured('msgpack serialization requires msgpack package')
+        if compression == LZ4 and lz4 is None:
+            raise ImproperlyConfigured('lz4 compression requires lz4 package')
+        self.format = format
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+
+    # plain data formats do not preserve classes, so complex values have to be packed into tuples first
+    @property
+    def plain_data(self):
+        return self.format != PICKLE
+
+    def _encode(self, format, value):
+        format_id, format_dumps, _ = _formats[format]
+        data = format_dumps(value)
+        compression_id, compress, _ = _compressions[self.compression]
+        if compress is not None and len(data) >= self.compress_threshold:
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                return bytes(bytearray([format_id | compression_id])) + compressed
+        return bytes(bytearray([format_id])) + data
+
+    def dumps(self, value):
+        if self.format != PICKLE:
+            try:
+                return self._encode(self.format, value)
+            except (TypeError, ValueError):
+                # values not representable as plain data, like exceptions, fall back to pickle
+                pass
+        return self._encode(PICKLE, value)
+
+    loads = staticmethod(loads)
+
+    def __repr__(self):
+        return 'Serializer(%r, %r, %r)' % (self.format, self.compression, self.compress_threshold)
+
+
+# writes plain pickles with the default protocol, readable by releases that do not know the header
+class LegacySerializer(object):
+
+    plain_data = False
+
+    def dumps(self, value):
+        return pickle.dumps(value)
+
+    loads = staticmethod(loads)
+
+    def __repr__(self):
+        return 'LegacySerializer()'
+
+
+def get_serializer(spec=None):
+    if spec is None:
+        spec = getattr(settings, 'SURROUND_SERIALIZER', None)
+        if spec is None:
+            return LegacySerializer()
+    if isinstance(spec, dict):
+        return Serializer(**spec)
+    return spec
@@ -0,0 +1,83 @@
+from __future__ import absolute_import
+from bisect import bisect
+import hashlib
+import threading
+from django.conf import settings
+
+
+def _hash(key):
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+# consistent hashing ring with a fixed number of virtual nodes per node, so that adding or removing
+# a node moves only about 1/n of the keys and the ring stays small enough for a quick bisect
+class HashRing(object):
+
+    def __init__(self, nodes, virtual_nodes=64):
+        self.nodes = list(nodes)
+        points = sorted((_hash('%s:%d' % (node, i)), node) for node in self.nodes for i in range(virtual_nodes))
+        self._hashes = [h for h, node in points]
+        self._nodes = [node for h, node in points]
+
+    def get_node(self, key):
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        return self._nodes[bisect(self._hashes, _hash(key)) % len(self._hashes)]
+
+    # groups a dict of name -> key by the nodes of the keys
+    def group(self, keys):
+        groups = {}
+        for name, key in keys.items():
+            groups.setdefault(self.get_node(key), {})[name] = key
+        return groups
+
+    def __repr__(self):
+        return 'HashRing(%r)' % self.nodes
+
+
+MAP_THREADS = getattr(settings, 'SURROUND_MAP_CONCURRENTLY_THREADS', 32)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# imported lazily, on python 2 the futures package is only needed once something gets mapped concurrently
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                from surround.django.coroutine.pool import LazyExecutor
+                _executor = LazyExecutor(lambda: ThreadPoolExecutor(max_workers=MAP_THREADS))
+    return _executor.get()
+
+
+def _call(func, item):
+    try:
+        return func(item), None
+    except Exception as e:
+        return None, e
+
+
+# calls func for every item concurrently, on a pool of SURROUND_MAP_CONCURRENTLY_THREADS threads shared by the
+# process, and returns the results in order; the first item is called in the calling thread, which then calls
+# the items no thread has picked up yet itself, so calls made from the pool threads cannot exhaust it. The first
+# exception raised by any of the calls is raised once all of them are finished
+def map_concurrently(func, items):
+    items = list(items)
+    if len(items) <= 1:
+        return [func(item) for item in items]
+
+    executor = _get_executor()
+    futures = [executor.submit(_call, func, item) for item in items[1:]]
+    outcomes = [_call(func, items[0])]
+    for future, item in zip(futures, items[1:]):
+        outcomes.append(_call(func, item) if future.cancel() else future.result())
+
+    for value, exception in outcomes:
+        if exception is not None:
+            raise exception
+    return [value for value, exception in outcomes]
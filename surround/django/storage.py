@@ -0,0 +1,118 @@
+from __future__ import absolute_import
+import math
+from surround.django.local_cache import LocalCache
+
+# Storage backends hold the entries of cache proxies. Values are opaque to them, ttls are given in seconds,
+# None meaning no expiry.
+
+
+class StorageBackend(object):
+
+    # whether tag keys can be attached to the stored entries, see set_many_with_ttl
+    supports_tags = False
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    # returns the values in the order of the keys, None for the missing ones; primary makes backends reading
+    # from replicas read from the primary, for state like locks that has to be current
+    def get_many(self, keys, primary=False):
+        raise NotImplementedError()
+
+    # items are (key, value, ttl) tuples; tags maps keys to the tag keys of their entries
+    # and is only taken into account by backends supporting tags
+    def set_many_with_ttl(self, items, tags=None):
+        raise NotImplementedError()
+
+    # returns the number of keys removed
+    def delete_many(self, keys):
+        raise NotImplementedError()
+
+    # stores only the keys not present yet, returns whether each of them was stored
+    def add_many_with_ttl(self, items):
+        raise NotImplementedError()
+
+    # locks are keys holding the token of their owner
+    def acquire_locks(self, keys, token, ttl):
+        return self.add_many_with_ttl([(key, token, ttl) for key in keys])
+
+    # not atomic here, a lock expiring in between may be released for its next owner
+    def release_locks(self, keys, token):
+        values = self.get_many(keys, primary=True)
+        return self.delete_many([key for key, value in zip(keys, values) if value == token])
+
+
+# any django cache, given by name or as the cache object itself
+class DjangoCacheBackend(StorageBackend):
+
+    def __init__(self, cache='default'):
+        if not hasattr(cache, 'get_many'):
+            try:
+                from django.core.cache import caches
+                cache = caches[cache]
+            except ImportError:
+                # django before 1.7
+                from django.core.cache import get_cache
+                cache = get_cache(cache)
+        self.cache = cache
+
+    # some django caches accept only whole seconds
+    @staticmethod
+    def _timeout(ttl):
+        return int(math.ceil(ttl)) if ttl is not None else None
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def get_many(self, keys, primary=False):
+        values = self.cache.get_many(keys)
+        return [values.get(key) for key in keys]
+
+    def set_many_with_ttl(self, items, tags=None):
+        by_ttl = {}
+        for key, value, ttl in items:
+            by_ttl.setdefault(self._timeout(ttl), {})[key] = value
+        for timeout, values in by_ttl.items():
+            self.cache.set_many(values, timeout)
+
+    def delete_many(self, keys):
+        deleted = len(self.cache.get_many(keys))
+        self.cache.delete_many(keys)
+        return deleted
+
+    def add_many_with_ttl(self, items):
+        return [bool(self.cache.add(key, value, self._timeout(ttl))) for key, value, ttl in items]
+
+    def __repr__(self):
+        return 'DjangoCacheBackend(%r)' % self.cache
+
+
+# dict in the memory of the process, bounded to maxsize entries evicted in LRU order; needs no server,
+# which suits single node deployments, development and benchmarks, but nothing is shared between processes
+class LocalMemoryBackend(StorageBackend):
+
+    def __init__(self, maxsize=10000, max_ttl=None):
+        self.cache = LocalCache(maxsize, max_ttl if max_ttl is not None else float('inf'))
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def get_many(self, keys, primary=False):
+        return [self.cache.get(key) for key in keys]
+
+    def set_many_with_ttl(self, items, tags=None):
+        for key, value, ttl in items:
+            self.cache.set(key, value, ttl)
+
+    def delete_many(self, keys):
+        return sum(1 for key in keys if self.cache.delete(key))
+
+    def add_many_with_ttl(self, items):
+        return [self.cache.add(key, value, ttl) for key, value, ttl in items]
+
+    @property
+    def stats(self):
+        return self.cache.stats
+
+    def __repr__(self):
+        return 'LocalMemoryBackend(%d)' % self.cache.maxsize
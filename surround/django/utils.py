@@ -4,11 +4,18 @@ from __future__ import absolute_import
 import functools
 import re
 from django.utils.functional import lazy
-from django.core.urlresolvers import reverse
+try:
+    from django.urls import reverse
+except ImportError:
+    from django.core.urlresolvers import reverse
 from django.conf import settings
-from urlparse import urljoin
+try:
+    from urlparse import urljoin
+except ImportError:
+    from urllib.parse import urljoin
 import datetime
 from collections import namedtuple
+from surround.django.storage import StorageBackend, DjangoCacheBackend
 
 from surround.django.logging import setupModuleLogger
 setupModuleLogger(globals())
@@ -119,10 +126,12 @@ class CacheKey(object):
         return CacheKey(self.pattern + ':' + str(other))
 
 
+# caches plain return values, unlike redis.CacheProxy, which caches results including exceptions;
+# backend is a storage.StorageBackend or a django cache
 class CacheProxy(object):
     def __init__(self, func, backend, timeout, key):
         self.func = func
-        self.backend = backend
+        self.backend = backend if isinstance(backend, StorageBackend) else DjangoCacheBackend(backend)
         self.timeout = timeout
         self.key = key
         #if key is not None else CacheKey(self.func.__name__ + ''.join([':{u}' for u in xrange(self.func.func_code.co_argcount)]))
@@ -136,11 +145,11 @@ class CacheProxy(object):
         if obj is not None:
             return obj
         obj = self.func(*args, **kwargs)
-        self.backend.set(key, obj, self.timeout)
+        self.backend.set_many_with_ttl([(key, obj, self.timeout)])
         return obj
 
     def delete(self, *args, **kwargs):
-        return self.backend.delete(self._key(args, kwargs))
+        return self.backend.delete_many([self._key(args, kwargs)]) > 0
 
     def purge(self, *args, **kwargs):
         return self.delete(*args, **kwargs)
@@ -150,9 +159,9 @@ class CacheProxy(object):
         return self(*args, **kwargs)
 
 
+# cache is the name of a django cache or a storage.StorageBackend
 def cache_result(timeout, key, cache='default'):
-    from django.core.cache import get_cache
-    backend = get_cache(cache)
+    backend = cache if isinstance(cache, StorageBackend) else DjangoCacheBackend(cache)
 
     def decorator(func):
         return CacheProxy(func, backend, timeout, key)
@@ -5,6 +5,8 @@ from django.shortcuts import render
 from surround.django import utils
 from django.core.urlresolvers import reverse
 from django.views.generic import View
+from django.http import HttpResponse
+from surround.django import instrumentation
 
 class DeprecatedAddress(View):
 
@@ -17,3 +19,7 @@ class DeprecatedAddress(View):
         response = render(request, 'deprecated_error_page.html', { 'url': reverse(self.new_view_name, args=args, kwargs=kwargs) }, status=404)
         utils.add_forward_error_header(response)
         return response
+
+
+def cache_metrics(request):
+    return HttpResponse(instrumentation.registry.prometheus(), content_type='text/plain; version=0.0.4')
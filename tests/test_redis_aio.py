@@ -0,0 +1,119 @@
+# smoke tests of the asyncio path, python 3 only; they need django, redis (>= 4.2, for redis.asyncio)
+# and redis_cache installed, but no running redis server
+import asyncio
+import unittest
+
+try:
+    import django
+    import redis.asyncio
+    from redis_cache import get_redis_connection
+except ImportError:
+    django = None
+
+if django is not None:
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(
+            INSTANCE_NAME='test',
+            SURROUND_ROOT_LOGGER_NAME='surround',
+            SURROUND_EXECUTION_DEBUG=False,
+            SURROUND_RUNNING_ON_PLATFORM=False,
+            SURROUND_COROUTINE_IMPLEMENTATION_MODULE='surround.django.coroutine.simple',
+        )
+
+
+@unittest.skipIf(django is None, 'django, redis.asyncio or redis_cache not installed')
+class RedisAioImportTest(unittest.TestCase):
+
+    def test_import(self):
+        from surround.django import redis_aio
+        self.assertTrue(callable(redis_aio.acache_result))
+
+    def test_acache_result(self):
+        from surround.django import redis_aio
+        from surround.django.utils import CacheKey
+
+        async def square(x):
+            return x * x
+
+        proxy = redis_aio.acache_result(60, CacheKey('square:{x}'))(square)
+        self.assertIsInstance(proxy, redis_aio.AsyncCacheProxy)
+        self.assertEqual(proxy._key((3,), {}), 'test:square:3')
+
+    def test_single_flight_rejected(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from surround.django import redis_aio
+        from surround.django.utils import CacheKey
+
+        async def square(x):
+            return x * x
+
+        with self.assertRaises(ImproperlyConfigured):
+            redis_aio.acache_result(60, CacheKey('square:{x}'), single_flight=True)(square)
+
+
+@unittest.skipIf(django is None, 'django, redis.asyncio or redis_cache not installed')
+class AioExecuteAllTest(unittest.TestCase):
+
+    def test_execute_all(self):
+        from surround.django import execution
+        from surround.django.coroutine import aio
+
+        async def square(x):
+            return x * x
+
+        def failing(x):
+            raise ValueError(x)
+
+        multi = execution.MultiParameters()
+        multi.bind('a', 2)
+        multi.bind('b', 3)
+        result = asyncio.run(aio.execute_all(square, multi, max_parallel=1))
+        self.assertEqual(result['a'], 4)
+        self.assertEqual(result['b'], 9)
+
+        result = asyncio.run(aio.execute_all(failing, multi))
+        self.assertIsInstance(result.get_result('a', throw_if_exception=False).exception, ValueError)
+
+
+@unittest.skipIf(django is None, 'django, redis.asyncio or redis_cache not installed')
+class StaleEntryLoaderTest(unittest.TestCase):
+
+    def test_loaded_outside_of_the_loop(self):
+        import time
+        from surround.django import execution
+        from surround.django import redis as sync_redis
+        from surround.django import redis_aio
+        from surround.django.utils import CacheKey
+
+        async def square(x):
+            return x * x
+
+        proxy = redis_aio.acache_result(60, CacheKey('square:{x}'), stale_timeout=60)(square)
+        refreshed = []
+
+        async def refresh_entry(key, parameters):
+            refreshed.append(key)
+
+        proxy._refresh_entry = refresh_entry
+        stale = sync_redis.CacheEntry(execution.Result(9, None), time.time() - 1, 0.0)
+        pickled_entry = proxy.serializer.dumps(proxy._pack_entry(stale))
+
+        async def find():
+            return proxy._entry_loader('test:square:3', pickled_entry, execution.Parameters((3,), {}))
+
+        # the loop multi() ran in is closed by the time the entry is accessed
+        load = asyncio.run(find())
+        self.assertEqual(load().value, 9)
+        self.assertEqual(refreshed, [])
+
+        # the entry is accessed in another thread while the loop is still running
+        async def find_and_load():
+            load = await find()
+            loop = asyncio.get_event_loop()
+            entry = await loop.run_in_executor(None, load)
+            await asyncio.sleep(0)
+            return entry
+
+        self.assertEqual(asyncio.run(find_and_load()).value, 9)
+        self.assertEqual(refreshed, ['test:square:3'])
@@ -0,0 +1,55 @@
+# round trips the values each serialization format has to preserve; msgpack and lz4 cases need the packages
+import unittest
+
+try:
+    import django
+except ImportError:
+    django = None
+
+if django is not None:
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(
+            INSTANCE_NAME='test',
+            SURROUND_ROOT_LOGGER_NAME='surround',
+            SURROUND_EXECUTION_DEBUG=False,
+            SURROUND_RUNNING_ON_PLATFORM=False,
+            SURROUND_COROUTINE_IMPLEMENTATION_MODULE='surround.django.coroutine.simple',
+        )
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+@unittest.skipIf(django is None, 'django not installed')
+class SerializerTest(unittest.TestCase):
+
+    values = [None, 1, 1.5, u'text', b'bytes', [1, u'a'], {u'a': 1}, {1: u'a', 2: [3]}]
+
+    def assertRoundTrip(self, serializer):
+        for value in self.values:
+            self.assertEqual(serializer.loads(serializer.dumps(value)), value)
+
+    def test_pickle(self):
+        from surround.django.serialization import Serializer, PICKLE, ZLIB
+        self.assertRoundTrip(Serializer(PICKLE))
+        self.assertRoundTrip(Serializer(PICKLE, ZLIB, compress_threshold=0))
+
+    def test_legacy(self):
+        from surround.django.serialization import LegacySerializer
+        self.assertRoundTrip(LegacySerializer())
+
+    @unittest.skipIf(msgpack is None, 'msgpack not installed')
+    def test_msgpack(self):
+        from surround.django.serialization import Serializer, MSGPACK, ZLIB
+        self.assertRoundTrip(Serializer(MSGPACK))
+        self.assertRoundTrip(Serializer(MSGPACK, ZLIB, compress_threshold=0))
+
+    @unittest.skipIf(msgpack is None, 'msgpack not installed')
+    def test_msgpack_int_keys(self):
+        from surround.django.serialization import Serializer, MSGPACK, loads
+        data = Serializer(MSGPACK).dumps({1: u'a'})
+        self.assertEqual(bytearray(data[:1])[0], 0x03)
+        self.assertEqual(loads(data), {1: u'a'})
@@ -0,0 +1,37 @@
+# storage backends needing no server
+import unittest
+
+try:
+    import django
+except ImportError:
+    django = None
+
+if django is not None:
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(
+            INSTANCE_NAME='test',
+            SURROUND_ROOT_LOGGER_NAME='surround',
+            SURROUND_EXECUTION_DEBUG=False,
+            SURROUND_RUNNING_ON_PLATFORM=False,
+            SURROUND_COROUTINE_IMPLEMENTATION_MODULE='surround.django.coroutine.simple',
+        )
+
+
+@unittest.skipIf(django is None, 'django not installed')
+class StorageBackendTest(unittest.TestCase):
+
+    def assertBackend(self, backend):
+        backend.set_many_with_ttl([('test:a', 1, 10), ('test:b', 2, None)])
+        self.assertEqual(backend.get_many(['test:a', 'test:b', 'test:c']), [1, 2, None])
+        self.assertEqual(backend.add_many_with_ttl([('test:a', 3, 10), ('test:c', 3, 10)]), [False, True])
+        self.assertEqual(backend.delete_many(['test:a', 'test:c']), 2)
+        self.assertEqual(backend.get_many(['test:a', 'test:b', 'test:c']), [None, 2, None])
+
+    def test_django_cache_by_name(self):
+        from surround.django.storage import DjangoCacheBackend
+        self.assertBackend(DjangoCacheBackend('default'))
+
+    def test_local_memory(self):
+        from surround.django.storage import LocalMemoryBackend
+        self.assertBackend(LocalMemoryBackend())